@@ -2,72 +2,291 @@
 """
 MeshCore Auth Token Generator
 Generates JWT-style authentication tokens for MQTT authentication
+
+Fully type-annotated so it can optionally be compiled with mypyc
+(`mypyc auth_token.py`); the resulting .so is picked up in place of this file.
 """
 import json
 import base64
 import hashlib
 import time
-import subprocess
 import sys
+from functools import lru_cache
+from typing import Union
+
+# PyNaCl is only needed once a token is actually signed or verified, so brokers
+# using username/password keep working on hosts without it (e.g. no armv7 wheel)
+try:
+    from nacl.bindings import crypto_scalarmult_ed25519_base_noclamp
+    from nacl.exceptions import BadSignatureError
+    from nacl.signing import VerifyKey
+    _HAVE_NACL: bool = True
+except ImportError:
+    _HAVE_NACL = False
+
+def _require_nacl() -> None:
+    if not _HAVE_NACL:
+        raise ImportError("PyNaCl not installed. Install with: pip install pynacl")
+
+# Order of the Ed25519 base point
+ED25519_L: int = 2**252 + 27742317777372353535851937790883648493
+
+# Raw key as hex string or bytes; bytes skip the hex decode
+KeyInput = Union[str, bytes]
+
+# Parsed signing key material: (scalar, nonce prefix, public key, uppercase public key hex)
+SigningKeyData = tuple[int, bytes, bytes, str]
+
+# Issued tokens: (public_key, private_key, claims, expiry_seconds) -> (token, iat, exp)
+# Callers cache tokens for most of their lifetime themselves, so a token is only
+# reused while it is still practically fresh (e.g. during a reconnect storm) and
+# has more than _TOKEN_REUSE_SECONDS of its lifetime left.
+_TOKEN_CACHE: dict[tuple[KeyInput, Union[KeyInput, SigningKeyData], tuple[tuple[str, object], ...], int], tuple[str, int, int]] = {}
+_TOKEN_CACHE_MAX: int = 32
+_TOKEN_REUSE_SECONDS: int = 60
+
+# Pre-serialized payload pieces around iat/exp: (public key hex, claims) -> (head, tail)
+_PAYLOAD_TEMPLATES: dict[tuple[str, tuple[tuple[str, str], ...]], tuple[str, str]] = {}
+_PAYLOAD_TEMPLATES_MAX: int = 128
+_RESERVED_CLAIMS: frozenset[str] = frozenset(("publicKey", "iat", "exp"))
 
 def base64url_encode(data: bytes) -> str:
     """Base64url encode without padding"""
-    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('utf-8')
+    encoded: bytes = base64.urlsafe_b64encode(data)
+    # Padding length is known from the input size: 0, 2 or 1 '=' for len % 3 == 0, 1, 2
+    return encoded[:len(encoded) - (-len(data) % 3)].decode('ascii')
+
+_HEADER_B64: str = base64url_encode(b'{"alg":"Ed25519","typ":"JWT"}')
+
+# ASCII whitespace removed from key files in a single bytes.translate pass
+_WS_BYTES: bytes = b' \t\n\r\x0b\x0c'
+_UTF8_BOM: bytes = b'\xef\xbb\xbf'
+
+@lru_cache(maxsize=128)
+def _get_signing_key(public_key: KeyInput, private_key: KeyInput) -> SigningKeyData:
+    """
+    Parse and validate key material once and reuse it for every later token.
+    
+    The private key is used as-is (scalar || prefix), so signing never re-runs
+    the SHA-512 seed expansion. The public key is checked against scalar * B
+    here, once, instead of letting a mismatched pair produce tokens the broker
+    will reject.
+    """
+    _require_nacl()
+    if isinstance(public_key, str):
+        public_key = bytes.fromhex(public_key)
+    if isinstance(private_key, str):
+        private_key = bytes.fromhex(private_key)
+    if len(public_key) != 32:
+        raise ValueError(f"Invalid public key length: {len(public_key)} bytes (expected 32)")
+    if len(private_key) != 64:
+        raise ValueError(f"Invalid private key length: {len(private_key)} bytes (expected 64)")
+    scalar = int.from_bytes(private_key[:32], 'little') % ED25519_L
+    if crypto_scalarmult_ed25519_base_noclamp(scalar.to_bytes(32, 'little')) != public_key:
+        raise ValueError("Private key does not match public key")
+    return (scalar, private_key[32:], public_key, public_key.hex().upper())
+
+def load_signing_key(public_key: KeyInput, private_key: KeyInput) -> SigningKeyData:
+    """
+    Load a device signing key once, at startup, for use with create_auth_token
+    
+    Args:
+        public_key: 32-byte public key, as hex or raw bytes
+        private_key: 64-byte private key as hex or raw bytes, or path to a key file
+    
+    Returns:
+        Parsed key to pass as create_auth_token's private key
+    
+    Raises:
+        ValueError: If the keys are not valid hex, have the wrong length or don't match
+        ImportError: If PyNaCl is not installed
+    """
+    if isinstance(private_key, str) and len(private_key) != 128:
+        private_key = read_private_key_file(private_key)
+    return _get_signing_key(public_key, private_key)
+
+def _check_loaded_key(public_key: KeyInput, key: SigningKeyData) -> SigningKeyData:
+    """Reject a loaded key passed together with some other device's public key"""
+    if isinstance(public_key, str):
+        matches = public_key.strip().upper() == key[3]
+    else:
+        matches = public_key == key[2]
+    if not matches:
+        raise ValueError("Public key does not match the loaded signing key")
+    return key
+
+def ed25519_sign_expanded(message: bytes, scalar: int, prefix: bytes, public_key: bytes) -> bytes:
+    """
+    Ed25519 signature using a MeshCore (orlp/ed25519) expanded private key.
+    
+    MeshCore stores SHA-512(seed) with the scalar already clamped: the first
+    32 bytes are the secret scalar, the last 32 bytes the nonce prefix. The seed
+    itself is not available, so libsodium's seed-based signing can't be used.
+    
+    Both SHA-512 passes go through hashlib, which CPython backs with OpenSSL's
+    vectorized implementation; libsodium only does the base-point multiply.
+    """
+    r = int.from_bytes(hashlib.sha512(prefix + message).digest(), 'little') % ED25519_L
+    R = crypto_scalarmult_ed25519_base_noclamp(r.to_bytes(32, 'little'))
+    k = int.from_bytes(hashlib.sha512(R + public_key + message).digest(), 'little') % ED25519_L
+    s = (r + k * scalar) % ED25519_L
+    return R + s.to_bytes(32, 'little')
+
+def _encode_payload(public_key_hex: str, now: int, expiry_seconds: int, claims: dict[str, str]) -> str:
+    """
+    Serialize the JWT payload, specialized per claim set.
+    
+    Only iat/exp change between tokens for the same device and claims, so the
+    JSON around them is built once with json.dumps and later tokens just splice
+    the two integers in. Output is byte-identical to json.dumps of the dict.
+    """
+    claim_items = tuple(claims.items())
+    try:
+        template = _PAYLOAD_TEMPLATES.get((public_key_hex, claim_items))
+    except TypeError:
+        template = None
+        claim_items = None  # Unhashable claim values: serialize without specializing
+    if template is None:
+        if claim_items is None or _RESERVED_CLAIMS.intersection(claims):
+            # Claims overriding publicKey/iat/exp change the key order; don't specialize
+            payload = {"publicKey": public_key_hex, "iat": now, "exp": now + expiry_seconds, **claims}
+            return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+        head = '{"publicKey":' + json.dumps(public_key_hex) + ',"iat":'
+        tail = json.dumps(claims, separators=(',', ':'), ensure_ascii=False)[1:]
+        if claims:
+            tail = ',' + tail
+        template = (head, tail)
+        if len(_PAYLOAD_TEMPLATES) >= _PAYLOAD_TEMPLATES_MAX:
+            _PAYLOAD_TEMPLATES.clear()
+        _PAYLOAD_TEMPLATES[(public_key_hex, claim_items)] = template
+    return f'{template[0]}{now},"exp":{now + expiry_seconds}{template[1]}'
+
+def _sign_token(key: SigningKeyData, now: int, expiry_seconds: int, claims: dict[str, str]) -> str:
+    """Build and sign a single token from already-parsed key material"""
+    scalar, prefix, public_key, public_key_hex = key
+    payload_b64 = base64url_encode(_encode_payload(public_key_hex, now, expiry_seconds, claims).encode('utf-8'))
+    signing_input = f"{_HEADER_B64}.{payload_b64}"
+    
+    signature = ed25519_sign_expanded(signing_input.encode('utf-8'), scalar, prefix, public_key)
+    return f"{signing_input}.{signature.hex().upper()}"
 
-def create_auth_token(public_key_hex: str, private_key_hex: str, expiry_seconds: int = 3600, **claims) -> str:
+def create_auth_token(public_key: KeyInput, private_key: Union[KeyInput, SigningKeyData], expiry_seconds: int = 3600, **claims: str) -> str:
     """
     Create a JWT-style auth token for MeshCore MQTT authentication
     
-    Uses the meshcore-decoder CLI tool.
+    Token format matches the meshcore-decoder CLI: Ed25519 header, hex signature.
+    Identical requests within _TOKEN_REUSE_SECONDS get the same cached token, as
+    long as it still has more than _TOKEN_REUSE_SECONDS left before it expires.
+    Passing raw bytes (or a loaded key) is the fast path; hex is decoded first.
     
     Args:
-        public_key_hex: 32-byte public key in hex format
-        private_key_hex: 64-byte private key in hex format (MeshCore format)
-        expiry_seconds: Token expiry time in seconds (default 24 hours)
+        public_key: 32-byte public key, as hex or raw bytes
+        private_key: Key from load_signing_key, or 64-byte private key (MeshCore format) as hex or raw bytes
+        expiry_seconds: Token expiry time in seconds (default 1 hour)
         **claims: Additional JWT claims (e.g., audience="mqtt.example.com", sub="device-123")
     
     Returns:
         JWT-style token string
+    
+    Raises:
+        ValueError: If the keys are not valid hex, have the wrong length or don't match
     """
+    now = time.time_ns() // 1_000_000_000
+    cache_key = (public_key, private_key, tuple(sorted(claims.items())), expiry_seconds)
     try:
-        cmd = ['meshcore-decoder', 'auth-token', public_key_hex, private_key_hex, '-e', str(expiry_seconds)]
-        
-        if claims:
-            claims_json = json.dumps(claims)
-            cmd.extend(['-c', claims_json])
-        
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode != 0:
-            raise Exception(f"meshcore-decoder error: {result.stderr}")
-        
-        token = result.stdout.strip()
-        if not token or token.count('.') != 2:
-            raise Exception(f"Invalid token format: {token}")
-        
+        cached = _TOKEN_CACHE.get(cache_key)
+    except TypeError:
+        # Unhashable claim values (lists, dicts) are signed every time
+        cache_key = cached = None
+    if cached and now - cached[1] < _TOKEN_REUSE_SECONDS and cached[2] - now > _TOKEN_REUSE_SECONDS:
+        return cached[0]
+    
+    if isinstance(private_key, tuple):
+        # A mismatch can't be cached, so checking on a cache miss is enough
+        key = _check_loaded_key(public_key, private_key)
+    else:
+        key = _get_signing_key(public_key, private_key)
+    token = _sign_token(key, now, expiry_seconds, claims)
+    if cache_key is None:
         return token
-        
-    except subprocess.TimeoutExpired:
-        raise Exception("Token generation timed out")
-    except FileNotFoundError:
-        raise Exception("meshcore-decoder CLI not found. Please install: npm install -g @michaelhart/meshcore-decoder")
-    except Exception as e:
-        raise Exception(f"Failed to generate auth token: {str(e)}")
+    
+    # Evict oldest entries first (dicts keep insertion order)
+    _TOKEN_CACHE.pop(cache_key, None)
+    while len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+        del _TOKEN_CACHE[next(iter(_TOKEN_CACHE))]
+    _TOKEN_CACHE[cache_key] = (token, now, now + expiry_seconds)
+    return token
+
+def create_auth_tokens_batch(keypairs: list[tuple[KeyInput, Union[KeyInput, SigningKeyData]]], expiry_seconds: int = 3600, **claims: str) -> list[str]:
+    """
+    Create auth tokens for many devices at once (e.g. a gateway serving a fleet)
+    
+    All keys are parsed up front and every token shares the same iat/exp, so the
+    loop only does payload encoding and signing. Batch tokens bypass the cache.
+    
+    Args:
+        keypairs: List of (public_key, private_key) tuples, keys as for create_auth_token
+        expiry_seconds: Token expiry time in seconds (default 1 hour)
+        **claims: Additional JWT claims applied to every token
+    
+    Returns:
+        List of tokens in the same order as keypairs
+    
+    Raises:
+        ValueError: If any key pair is invalid (no tokens are returned)
+    """
+    keys = [
+        _check_loaded_key(public_key, private_key) if isinstance(private_key, tuple)
+        else _get_signing_key(public_key, private_key)
+        for public_key, private_key in keypairs
+    ]
+    now = time.time_ns() // 1_000_000_000
+    return [_sign_token(key, now, expiry_seconds, claims) for key in keys]
+
+def verify_auth_token(token: str, public_key: KeyInput) -> dict[str, object]:
+    """
+    Verify a token's signature with libsodium's standard Ed25519 verifier
+    
+    The signer above is hand-rolled on top of the expanded MeshCore key; this
+    checks its output with an independent, well-tested implementation.
+    
+    Args:
+        token: Token from create_auth_token
+        public_key: 32-byte public key, as hex or raw bytes
+    
+    Returns:
+        Decoded payload claims
+    
+    Raises:
+        ValueError: If the token is malformed or the signature doesn't verify
+        ImportError: If PyNaCl is not installed
+    """
+    _require_nacl()
+    if isinstance(public_key, str):
+        public_key = bytes.fromhex(public_key)
+    parts = token.split('.')
+    if len(parts) != 3:
+        raise ValueError("Invalid token format")
+    header_b64, payload_b64, signature_hex = parts
+    try:
+        VerifyKey(public_key).verify(f"{header_b64}.{payload_b64}".encode('utf-8'), bytes.fromhex(signature_hex))
+    except BadSignatureError:
+        raise ValueError("Invalid token signature")
+    payload: dict[str, object] = json.loads(base64.urlsafe_b64decode(payload_b64 + '=' * (-len(payload_b64) % 4)))
+    return payload
 
 def read_private_key_file(filepath: str) -> str:
     """Read private key from file (64-byte hex format)"""
     try:
-        with open(filepath, 'r') as f:
-            key = f.read().strip()
-            key = ''.join(key.split())
-            if len(key) != 128:  # 64 bytes = 128 hex chars
-                raise ValueError(f"Invalid private key length: {len(key)} (expected 128)")
-            int(key, 16)
+        with open(filepath, 'rb') as f:
+            data = f.read().removeprefix(_UTF8_BOM).translate(None, _WS_BYTES)
+            if len(data) != 128:  # 64 bytes = 128 hex chars
+                raise ValueError(f"Invalid private key length: {len(data)} (expected 128)")
+            try:
+                key = data.decode('ascii')
+                bytes.fromhex(key)
+            except ValueError:
+                raise ValueError("non-hex character in key")
             return key
     except FileNotFoundError:
         raise Exception(f"Private key file not found: {filepath}")
@@ -83,19 +302,19 @@ if __name__ == "__main__":
     public_key = sys.argv[1]
     private_key_input = sys.argv[2]
     
-    if len(private_key_input) < 128:
-        try:
-            private_key = read_private_key_file(private_key_input)
+    try:
+        signing_key = load_signing_key(public_key, private_key_input)
+        if len(private_key_input) != 128:
             print(f"Loaded private key from: {private_key_input}")
-        except Exception as e:
-            print(f"Error: {e}")
-            sys.exit(1)
-    else:
-        private_key = private_key_input
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
     
     try:
-        token = create_auth_token(public_key, private_key)
+        token = create_auth_token(public_key, signing_key)
         print(f"Generated token: {token}")
+        verify_auth_token(token, public_key)
+        print("Signature verified")
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
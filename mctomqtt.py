@@ -4,60 +4,93 @@ import os
 import json
 import serial
 import threading
+import queue
+import heapq
+import itertools
 import argparse
+import ctypes
 import re
+import string
+import struct
 import time
-import calendar
 import logging
 import signal
 import random
 import subprocess
+from collections import defaultdict, deque
+from concurrent.futures import ALL_COMPLETED, Future, wait as futures_wait
+from dataclasses import dataclass, field
+from functools import partial
 from datetime import datetime
-from time import sleep
-from auth_token import create_auth_token, read_private_key_file
+from auth_token import create_auth_token, load_signing_key
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
     import paho.mqtt.client as mqtt
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.properties import Properties
 except ImportError:
     print("Error: paho-mqtt not installed. Install with:")
     print("pip install paho-mqtt")
     sys.exit(1)
 
+def dumps_json(obj):
+    """Serialize a payload to compact UTF-8 JSON bytes (orjson when installed)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+# Parsed .env files: (path, mtime_ns) -> {KEY: VALUE}
+_ENV_CACHE = {}
+
+# Client version strings: (path, mtime_ns) -> version
+_VERSION_CACHE = {}
+
+def parse_env_file(filepath):
+    """Parse a .env file and return a dictionary (cached until the file changes)"""
+    try:
+        mtime_ns = os.stat(filepath).st_mtime_ns
+    except OSError:
+        return {}
+    
+    cached = _ENV_CACHE.get((filepath, mtime_ns))
+    if cached is not None:
+        return cached
+    
+    env_vars = {}
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for raw in f:
+            line = raw.lstrip()
+            # Skip comments and empty lines
+            if not line or line[0] == '#':
+                continue
+            # Parse KEY=VALUE
+            eq = line.find('=')
+            if eq < 0:
+                continue
+            key = line[:eq].rstrip()
+            value = line[eq + 1:].strip()
+            # Remove quotes if present
+            if value and value[0] in ('"', "'") and value[-1] == value[0]:
+                value = value[1:-1]
+            env_vars[key] = value
+    
+    _ENV_CACHE[(filepath, mtime_ns)] = env_vars
+    return env_vars
+
 def load_env_files():
     """Load environment variables from .env and .env.local files"""
     script_dir = os.path.dirname(os.path.abspath(__file__))
     env_file = os.path.join(script_dir, '.env')
     env_local_file = os.path.join(script_dir, '.env.local')
     
-    def parse_env_file(filepath):
-        """Parse a .env file and return a dictionary"""
-        env_vars = {}
-        if not os.path.exists(filepath):
-            return env_vars
-        
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip comments and empty lines
-                if not line or line.startswith('#'):
-                    continue
-                # Parse KEY=VALUE
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip()
-                    # Remove quotes if present
-                    if value and value[0] in ('"', "'") and value[-1] == value[0]:
-                        value = value[1:-1]
-                    env_vars[key] = value
-        return env_vars
-    
-    # Load .env first (defaults)
-    env_vars = parse_env_file(env_file)
-    
-    # Load .env.local (overrides)
-    local_vars = parse_env_file(env_local_file)
-    env_vars.update(local_vars)
+    # Load .env first (defaults), then .env.local (overrides)
+    env_vars = dict(parse_env_file(env_file))
+    env_vars.update(parse_env_file(env_local_file))
     
     # Set environment variables
     for key, value in env_vars.items():
@@ -72,33 +105,53 @@ def log_config_sources():
     env_file = os.path.join(script_dir, '.env')
     env_local_file = os.path.join(script_dir, '.env.local')
     
-    logger.info(f"Config directory: {script_dir}")
-    logger.debug(f".env file: {env_file} (exists: {os.path.exists(env_file)})")
-    logger.debug(f".env.local file: {env_local_file} (exists: {os.path.exists(env_local_file)})")
-    
-    if not os.path.exists(env_local_file):
+    logger.info("Config directory: %s", script_dir)
+    local_exists = os.path.exists(env_local_file)
+    if not local_exists:
         logger.warning(".env.local file not found - using defaults from .env only")
-    else:
+    
+    # Everything below is debug output only
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    
+    logger.debug(".env file: %s (exists: %s)", env_file, os.path.exists(env_file))
+    logger.debug(".env.local file: %s (exists: %s)", env_local_file, local_exists)
+    
+    if local_exists:
+        # Reuse the values parsed at startup instead of re-reading the file
         logger.debug("=== .env.local configuration ===")
         try:
-            with open(env_local_file, 'r') as f:
-                for line in f:
-                    line = line.rstrip()
-                    if line and not line.startswith('#'):
-                        logger.debug(f"  {line}")
+            for key, value in parse_env_file(env_local_file).items():
+                if 'PASSWORD' in key or 'TOKEN' in key:
+                    value = '********'
+                logger.debug("  %s=%s", key, value)
         except Exception as e:
-            logger.error(f"Error reading .env.local: {e}")
+            logger.error("Error reading .env.local: %s", e)
         logger.debug("================================")
 
 # Load environment configuration
 load_env_files()
 
 # Regex patterns for message parsing
-RAW_PATTERN = re.compile(r"(\d{2}:\d{2}:\d{2}) - (\d{1,2}/\d{1,2}/\d{4}) U RAW: (.*)")
-PACKET_PATTERN = re.compile(
-    r"(\d{2}:\d{2}:\d{2}) - (\d{1,2}/\d{1,2}/\d{4}) U: (RX|TX), len=(\d+) \(type=(\d+), route=([A-Z]), payload_len=(\d+)\)"
-    r"(?: SNR=(-?\d+) RSSI=(-?\d+) score=(\d+)( time=(\d+))? hash=([0-9A-F]+)(?: \[(.*)\])?)?"
+# One anchored scan classifies a log line: groups 1-7 are an RX/TX packet head, group 8
+# the hex of a RAW line. The optional RX tail is matched from where the head ended
+# (PACKET_TAIL.match(line, head.end())). No nested quantifiers, so no runaway backtracking.
+LINE_PATTERN = re.compile(
+    r"\A(\d{2}:\d{2}:\d{2}) - (\d{1,2}/\d{1,2}/\d{4}) U"
+    r"(?:: (RX|TX), len=(\d+) \(type=(\d+), route=([A-Z]), payload_len=(\d+)\)| RAW: (.*))"
 )
+PACKET_TAIL = re.compile(r" SNR=(-?\d+) RSSI=(-?\d+) score=(\d+)(?: time=(\d+))? hash=([0-9A-F]+)(?: \[(.*)\])?")
+
+# Binary PACKET encoding (PACKET_ENCODING=binary), little endian:
+#   version B, flags B (bit0 RX tail present, bit1 duration present), direction B (0 rx, 1 tx),
+#   packet_type B, route 1 char, len H, payload_len H, SNR h, RSSI h, score H, duration I,
+#   timestamp q (epoch microseconds), origin_id 32 bytes (public key)
+# followed by origin, "time date" from the radio, hash and path as B-length-prefixed ASCII/UTF-8
+# strings, then the raw packet bytes prefixed by their H length.
+PACKET_BINARY_VERSION = 1
+PACKET_STRUCT = struct.Struct("<BBBBcHHhhHIq32s")
+PACKET_FLAG_RX_TAIL = 0x01
+PACKET_FLAG_DURATION = 0x02
 
 # Initialize logging (console only)
 log_level_str = os.getenv('MCTOMQTT_LOG_LEVEL', 'INFO').upper()
@@ -110,82 +163,430 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# CLI replies: "  -> > value" for get commands, "  -> value" otherwise
+GET_REPLY_RE = re.compile(r"-> >[ \t]*([^\r\n]*)")
+REPLY_RE = re.compile(r"-> ([^\r\n]*)")
+_STRIP_WS = str.maketrans('', '', ' \t\r\n')
+
+# MQTT client IDs keep only [a-zA-Z0-9_-]
+_CLIENT_ID_KEEP = frozenset(string.ascii_letters + string.digits + '_-')
+_CLIENT_ID_TRANS = str.maketrans('', '', ''.join(chr(i) for i in range(128) if chr(i) not in _CLIENT_ID_KEEP))
+
+# Seconds between WebSocket PING frames on websockets transports
+WS_PING_INTERVAL = 45
+
+# Device stats queries and the fields kept from each JSON reply
+DEVICE_STATS_COMMANDS = (
+    ("stats-core", ("battery_mv", "uptime_secs", "errors", "queue_len")),
+    ("stats-radio", ("noise_floor", "tx_air_secs", "rx_air_secs")),
+)
+
+# (suffix, divisor, decimals) indexed by (bit_length - 1) // 10
+BYTE_UNITS = (("B", 1, 0), ("KB", 1 << 10, 1), ("MB", 1 << 20, 1), ("GB", 1 << 30, 2))
+
+def format_bytes(num_bytes):
+    """Format a byte count as B/KB/MB/GB"""
+    suffix, divisor, decimals = BYTE_UNITS[min(3, max(0, (num_bytes.bit_length() - 1) // 10))]
+    return f"{num_bytes / divisor:.{decimals}f}{suffix}"
+
+def format_uptime(seconds):
+    """Format seconds as "Xh Ym", or "Ym" under an hour"""
+    hours, rem = divmod(seconds, 3600)
+    minutes = rem // 60
+    return "%dh %dm" % (hours, minutes) if hours else "%dm" % minutes
+
+_iso_second = (None, "")  # (epoch second, local ISO string up to the seconds)
+
+def iso_now():
+    """Local time as datetime.now().isoformat(); the date/time part is formatted once per second"""
+    global _iso_second
+    now_us = time.time_ns() // 1000
+    sec, us = divmod(now_us, 1_000_000)
+    cached_sec, prefix = _iso_second
+    if sec != cached_sec:
+        prefix = datetime.fromtimestamp(sec).isoformat()
+        _iso_second = (sec, prefix)
+    return f"{prefix}.{us:06d}" if us else prefix
+
+class _Timex(ctypes.Structure):
+    """Leading fields of the kernel's struct timex; the tail is reserved space"""
+    _fields_ = [("modes", ctypes.c_uint), ("offset", ctypes.c_long), ("freq", ctypes.c_long),
+                ("maxerror", ctypes.c_long), ("esterror", ctypes.c_long), ("status", ctypes.c_int),
+                ("_rest", ctypes.c_byte * 256)]
+
+# systemd reports "System clock synchronized: yes" when maxerror is below this (us).
+# STA_UNSYNC is deliberately not checked: NTP daemons set it just to stop the kernel's
+# 11-minute RTC writes (e.g. chrony without rtcsync), and systemd ignores it too.
+MAXERROR_UNSYNCED = 16000000
+
+try:
+    _adjtimex = ctypes.CDLL(None, use_errno=True).adjtimex
+except (OSError, AttributeError):
+    _adjtimex = None  # Not Linux/glibc: fall back to timedatectl
+
+def kernel_clock_synchronized():
+    """Read the kernel NTP state with adjtimex(); None when the call is unavailable"""
+    if _adjtimex is None:
+        return None
+    tx = _Timex()  # modes=0: read only, no privileges needed
+    if _adjtimex(ctypes.byref(tx)) == -1:
+        return None
+    return tx.maxerror < MAXERROR_UNSYNCED
+
+# Stands in for the timestamp in the cached status payload (see status_payload)
+STATUS_TS_PLACEHOLDER = "\x00timestamp\x00"
+STATUS_TS_PLACEHOLDER_BYTES = dumps_json(STATUS_TS_PLACEHOLDER)[1:-1]
+
+# Topic types that can be configured globally (TOPIC_*) or per broker (MQTT{n}_TOPIC_*)
+TOPIC_TYPES = ("status", "packets", "debug")
+
+@dataclass(slots=True, frozen=True)
+class BrokerConfig:
+    """Per-broker settings resolved once from the environment at startup"""
+    broker_num: int
+    enabled: bool
+    server: str
+    port: int
+    transport: str
+    keepalive: int
+    use_tls: bool
+    tls_verify: bool
+    use_auth_token: bool
+    token_audience: str
+    token_owner: str
+    token_email: str
+    username: str
+    password: str
+    iata: str
+    topic_templates: dict  # topic type -> template (broker override or global)
+    client_id_prefix: str
+    qos: int  # MQTT{n}_QOS with 1 already forced down to 0
+    retain: bool  # Retain flag for the online status message
+    batch_enabled: bool  # Coalesce non-retained publishes into MQTT 5 batches
+    batch_max_messages: int
+    batch_max_bytes: int
+    batch_open_ms: int
+
+
+class TTLCache:
+    """Dict-backed cache whose entries expire at an absolute monotonic time"""
+    __slots__ = ('_entries',)
+    
+    def __init__(self):
+        self._entries = {}  # key -> (value, expiry)
+    
+    def get(self, key, now):
+        """Return the value for key, or None (evicting it) once now reaches its expiry"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expiry = entry
+        if now < expiry:
+            return value
+        del self._entries[key]
+        return None
+    
+    def set(self, key, value, expiry):
+        self._entries[key] = (value, expiry)
+    
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+
+def _short_field(value):
+    """B-length-prefixed bytes for the variable part of a binary packet"""
+    data = value.encode()[:255] if value else b""
+    return bytes((len(data),)) + data
+
+def encode_packet_binary(packet_match, tail, origin, origin_id, raw):
+    """Pack a matched RX/TX line into the PACKET_STRUCT layout; raises ValueError if it does not fit"""
+    direction = packet_match.group(3)
+    flags = 0
+    snr = rssi = score = duration = 0
+    packet_hash = path = None
+    if tail:
+        flags |= PACKET_FLAG_RX_TAIL
+        snr, rssi, score = int(tail[0]), int(tail[1]), int(tail[2])
+        if tail[3] is not None:
+            flags |= PACKET_FLAG_DURATION
+            duration = int(tail[3])
+        packet_hash, path = tail[4], tail[5]
+    raw = raw or b""
+    try:
+        header = PACKET_STRUCT.pack(
+            PACKET_BINARY_VERSION, flags, 0 if direction == "RX" else 1, int(packet_match.group(5)),
+            packet_match.group(6).encode(), int(packet_match.group(4)), int(packet_match.group(7)),
+            snr, rssi, score, duration, time.time_ns() // 1000, origin_id or bytes(32)
+        )
+    except struct.error as e:
+        raise ValueError(str(e)) from None
+    if len(raw) > 0xFFFF:
+        raise ValueError("raw packet too long")
+    return b"".join((
+        header,
+        _short_field(origin),
+        _short_field(f"{packet_match.group(1)} {packet_match.group(2)}"),
+        _short_field(packet_hash),
+        _short_field(path),
+        len(raw).to_bytes(2, "little"),
+        raw,
+    ))
+
+def encode_varint(value):
+    """Encode a non-negative int as an MQTT-style variable byte integer (7 bits per byte)"""
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+class BatchPublisher:
+    """
+    Coalesce payloads per topic and hand them to publish(topic, payload, count) as one
+    batch: each message is prefixed with its varint-encoded length. A batch is flushed
+    when it reaches max_messages or max_bytes, or max_open seconds after it was opened.
+    """
+    
+    def __init__(self, publish, max_messages=10, max_bytes=65536, max_open=0.02):
+        self._publish = publish
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self._batches = {}  # topic -> [flush_deadline, total_bytes, [payload, ...]]
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def add(self, topic, payload):
+        """Queue a payload (bytes) for topic, flushing inline if the batch is full"""
+        full = None
+        with self._cond:
+            if self._thread is None:
+                # Started on first use, under the lock so concurrent callers start only one
+                self._thread = threading.Thread(target=self._flush_loop, daemon=True, name="MQTT-Batcher")
+                self._thread.start()
+            batch = self._batches.get(topic)
+            if batch is None:
+                batch = self._batches[topic] = [time.monotonic() + self.max_open, 0, []]
+                self._cond.notify()
+            batch[1] += len(payload)
+            batch[2].append(payload)
+            if len(batch[2]) >= self.max_messages or batch[1] >= self.max_bytes:
+                full = self._batches.pop(topic)[2]
+        
+        if full:
+            self._flush(topic, full)
+    
+    def flush_all(self):
+        """Publish every open batch now (used at shutdown)"""
+        with self._cond:
+            batches, self._batches = self._batches, {}
+        for topic, batch in batches.items():
+            self._flush(topic, batch[2])
+    
+    def _flush(self, topic, messages):
+        payload = b"".join(encode_varint(len(message)) + message for message in messages)
+        self._publish(topic, payload, len(messages))
+    
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                if not self._batches:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                next_deadline = min(batch[0] for batch in self._batches.values())
+                if next_deadline > now:
+                    self._cond.wait(next_deadline - now)
+                    continue
+                due = [topic for topic, batch in self._batches.items() if batch[0] <= now]
+                flushes = [(topic, self._batches.pop(topic)[2]) for topic in due]
+            for topic, messages in flushes:
+                self._flush(topic, messages)
+
+
+@dataclass(slots=True)
+class Stats:
+    """Runtime counters updated on the packet path and reported by the stats logger"""
+    start_time: float
+    last_stats_log: float
+    packets_rx: int = 0
+    packets_tx: int = 0
+    packets_rx_prev: int = 0
+    packets_tx_prev: int = 0
+    bytes_processed: int = 0
+    publish_failures: int = 0
+    # {broker_num: deque([int monotonic seconds, ...], maxlen=1024)}
+    reconnects: dict = field(default_factory=lambda: defaultdict(partial(deque, maxlen=1024)))
+    device: dict = field(default_factory=dict)  # Device stats from serial (battery, uptime, errors, etc.)
+    device_prev: dict = field(default_factory=dict)  # Previous device stats for delta calculation
+
+
 class MeshCoreBridge:
-    last_raw: bytes = None
+    last_raw_bytes: bytes = None  # Payload of the last RAW line, decoded once
+
+    @property
+    def last_raw(self):
+        """Last RAW payload as the uppercase hex the firmware prints (None before the first one)"""
+        return self.last_raw_bytes.hex().upper() if self.last_raw_bytes is not None else None
 
     def __init__(self, debug=False):
         self.debug = debug
+        # Snapshot of MCTOMQTT_* settings (prefix stripped); config is fixed after startup
+        self._env = {k[len('MCTOMQTT_'):]: v for k, v in os.environ.items() if k.startswith('MCTOMQTT_')}
+        self._env_bool = {}  # (key, fallback) -> parsed bool
+        self._env_int = {}  # (key, fallback) -> parsed int
         self.repeater_name = None
         self.repeater_pub_key = None
+        self.resolved_topics = {}
+        self._topic_lookup = {}  # (topic_type, broker_num) -> topic, filled by _resolve_all_topics
         self.repeater_priv_key = None
+        self._repeater_pub_key_bytes = None  # Decoded once while validating the hex keys
+        self._repeater_priv_key_bytes = None
+        self.signing_key = None  # Parsed once from repeater_priv_key for auth tokens
+        self._token_username = None  # "v1_<PUBKEY>", set once the pub key is known
         self.radio_info = None
         self.firmware_version = None
         self.model = None
         self.client_version = self._load_client_version()
         self.ser = None
-        self.ser_lock = threading.Lock()  # Lock for thread-safe serial access
+        self.ser_lock = threading.RLock()  # Serializes command/reply exchanges (the reader never takes it)
+        self._rx_buf = bytearray()  # Bytes read from serial not yet split into lines
+        self._rx_cond = threading.Condition()  # Guards _rx_buf/_awaiting_reply, signalled on new data
+        self._awaiting_reply = False  # While set, the reader leaves _rx_buf to the command helper
+        self._rx_lines = queue.SimpleQueue()  # Complete lines for the main loop
+        self._reader_thread = None
         self.mqtt_clients = []
+        self._clients_by_num = {}  # broker_num -> entry of mqtt_clients
+        self._clients_by_obj = {}  # id(paho client) -> entry of mqtt_clients
+        self._packet_routes = []  # One publish callable per broker for the packet stream
         self.mqtt_connected = False
-        self.connection_events = {}  # Track connection completion per broker
+        self._connected_count = 0  # Brokers whose entry is marked connected; drives mqtt_connected
+        self._connected_lock = threading.Lock()
+        self.connection_events = {}  # broker_num -> Future completed by the first connect outcome
         self.should_exit = False
-        self.global_iata = os.getenv('MCTOMQTT_IATA', 'XXX')
+        self.global_iata = self.get_env('IATA', 'XXX')
         self.reconnect_delay = 1.0  # Start with 1 second
         self.max_reconnect_delay = 120.0  # Max 2 minutes
         self.reconnect_backoff = 1.5  # Exponential backoff multiplier
         self.reconnect_attempts = {}  # Track consecutive failed reconnect attempts per broker
         self.max_reconnect_attempts = 12  # Exit after this many consecutive failures
-        self.token_cache = {}  # Cache tokens with their creation time
+        self.token_cache = TTLCache()  # broker_num -> auth token, expiring on monotonic time
         self.token_ttl = 3600  # 1 hour token TTL
-        self.ws_ping_threads = {}  # Track WebSocket ping threads per broker
+        self.ws_clients = {}  # broker_num -> websockets client currently kept alive
+        self._ws_keepalive_heap = []  # (next_ping_monotonic, seq, broker_num, client)
+        self._ws_keepalive_seq = itertools.count()  # Tie-breaker so clients are never compared
+        self._ws_keepalive_cond = threading.Condition()
+        self._ws_keepalive_thread = None
         self.sync_time_at_start = self.get_env_bool('SYNC_TIME', True) # issues a command to sync the pi's clock at script start
+        # PACKET messages as JSON (default) or the compact PACKET_STRUCT layout
+        self.packet_encoding = self.get_env('PACKET_ENCODING', 'json').strip().lower()
+        if self.packet_encoding not in ('json', 'binary'):
+            logger.warning(f"Unknown PACKET_ENCODING '{self.packet_encoding}', using json")
+            self.packet_encoding = 'json'
+        self.broker_configs = {n: self._load_broker_config(n) for n in range(1, 5)}
+        # Opt-in per broker: non-retained publishes are coalesced (needs an MQTT 5 broker)
+        self._batchers = {
+            n: BatchPublisher(partial(self._publish_batch, n), config.batch_max_messages,
+                              config.batch_max_bytes, config.batch_open_ms / 1000)
+            for n, config in self.broker_configs.items() if config.enabled and config.batch_enabled
+        }
 
         # Statistics tracking
-        self.stats = {
-            'start_time': time.time(),
-            'packets_rx': 0,
-            'packets_tx': 0,
-            'packets_rx_prev': 0,
-            'packets_tx_prev': 0,
-            'bytes_processed': 0,
-            'publish_failures': 0,
-            'last_stats_log': time.time(),
-            'reconnects': {},  # {broker_num: [timestamp1, timestamp2, ...]}
-            'device': {},  # Device stats from serial (battery, uptime, errors, etc.)
-            'device_prev': {}  # Previous device stats for delta calculation
-        }
+        self.stats = Stats(start_time=time.monotonic(), last_stats_log=time.monotonic())
+        self._status_static_key = None  # Identity fields the cached status fields were built from
+        self._status_static = {}
+        # (key, bytes) of the last serialized status; only the timestamp differs between publishes
+        self._status_payload_cache = (None, b'')
+        self._stats_fmt = ("[SERVICE] Uptime: %s | RX/TX: %d/%d (5m: %.1f/min) | RX bytes: %s | "
+                           "MQTT: %d/%d | Reconnects/24h: %s | Failures: %d")
         
         logger.info("Configuration loaded from environment variables")
     
     def _load_client_version(self):
-        """Load client version from .version_info file"""
+        """Load client version from .version_info file (read once per file change)"""
         try:
             script_dir = os.path.dirname(os.path.abspath(__file__))
             version_file = os.path.join(script_dir, '.version_info')
             if os.path.exists(version_file):
-                with open(version_file, 'r') as f:
-                    version_data = json.load(f)
-                    installer_ver = version_data.get('installer_version', 'unknown')
-                    git_hash = version_data.get('git_hash', 'unknown')
-                    return f"meshcoretomqtt/{installer_ver}-{git_hash}"
+                cache_key = (version_file, os.stat(version_file).st_mtime_ns)
+                if cache_key not in _VERSION_CACHE:
+                    with open(version_file, 'r') as f:
+                        version_data = json.load(f)
+                        installer_ver = version_data.get('installer_version', 'unknown')
+                        git_hash = version_data.get('git_hash', 'unknown')
+                        _VERSION_CACHE[cache_key] = f"meshcoretomqtt/{installer_ver}-{git_hash}"
+                return _VERSION_CACHE[cache_key]
         except Exception as e:
-            logger.debug(f"Could not load version info: {e}")
+            logger.debug("Could not load version info: %s", e)
         return "meshcoretomqtt/unknown"
     
     def get_env(self, key, fallback=''):
         """Get environment variable with fallback (all vars are MCTOMQTT_ prefixed)"""
-        return os.getenv(f"MCTOMQTT_{key}", fallback)
+        return self._env.get(key, fallback)
     
     def get_env_bool(self, key, fallback=False):
         """Get boolean environment variable, checking MCTOMQTT_ prefix first"""
-        value = self.get_env(key, str(fallback)).lower()
-        return value in ('true', '1', 'yes', 'on')
+        cache_key = (key, fallback)
+        value = self._env_bool.get(cache_key)
+        if value is None:
+            value = self.get_env(key, str(fallback)).lower() in ('true', '1', 'yes', 'on')
+            self._env_bool[cache_key] = value
+        return value
     
     def get_env_int(self, key, fallback=0):
         """Get integer environment variable, checking MCTOMQTT_ prefix first"""
-        try:
-            return int(self.get_env(key, str(fallback)))
-        except ValueError:
-            return fallback
+        cache_key = (key, fallback)
+        value = self._env_int.get(cache_key)
+        if value is None:
+            try:
+                value = int(self.get_env(key, str(fallback)))
+            except ValueError:
+                value = fallback
+            self._env_int[cache_key] = value
+        return value
+    
+    def _load_broker_config(self, broker_num):
+        """Resolve all MQTT{n}_* settings for one broker into a BrokerConfig"""
+        prefix = f"MQTT{broker_num}_"
+        topic_templates = {}
+        for topic_type in TOPIC_TYPES:
+            topic_type_upper = topic_type.upper()
+            topic_templates[topic_type] = (self.get_env(f"{prefix}TOPIC_{topic_type_upper}", "")
+                                           or self.get_env(f"TOPIC_{topic_type_upper}", ""))
+        
+        qos = self.get_env_int(f"{prefix}QOS", 0)
+        return BrokerConfig(
+            broker_num=broker_num,
+            enabled=self.get_env_bool(f"{prefix}ENABLED", False),
+            server=self.get_env(f"{prefix}SERVER", ""),
+            port=self.get_env_int(f"{prefix}PORT", 1883),
+            transport=self.get_env(f"{prefix}TRANSPORT", "tcp"),
+            keepalive=self.get_env_int(f"{prefix}KEEPALIVE", 60),
+            use_tls=self.get_env_bool(f"{prefix}USE_TLS", False),
+            tls_verify=self.get_env_bool(f"{prefix}TLS_VERIFY", True),
+            use_auth_token=self.get_env_bool(f"{prefix}USE_AUTH_TOKEN", False),
+            token_audience=self.get_env(f"{prefix}TOKEN_AUDIENCE", ""),
+            token_owner=self.get_env(f"{prefix}TOKEN_OWNER", ""),
+            token_email=self.get_env(f"{prefix}TOKEN_EMAIL", ""),
+            username=self.get_env(f"{prefix}USERNAME", ""),
+            password=self.get_env(f"{prefix}PASSWORD", ""),
+            iata=self.get_env(f"{prefix}IATA", "") or self.global_iata,
+            topic_templates=topic_templates,
+            # Historically only MQTT1_CLIENT_ID_PREFIX existed; it stays the default for all brokers
+            client_id_prefix=self.get_env(f"{prefix}CLIENT_ID_PREFIX", self.get_env("MQTT1_CLIENT_ID_PREFIX", "meshcore_")),
+            # qos 1 is forced to 0 because it can cause retry storms
+            qos=0 if qos == 1 else qos,
+            retain=self.get_env_bool(f"{prefix}RETAIN", True),
+            batch_enabled=self.get_env_bool(f"{prefix}BATCH_ENABLED", False),
+            batch_max_messages=self.get_env_int(f"{prefix}BATCH_MAX_MESSAGES", 10),
+            batch_max_bytes=self.get_env_int(f"{prefix}BATCH_MAX_BYTES", 65536),
+            batch_open_ms=self.get_env_int(f"{prefix}BATCH_OPEN_MS", 20),
+        )
     
     def resolve_topic_template(self, template, broker_num=None):
         """Resolve topic template with {IATA} and {PUBLIC_KEY} placeholders"""
@@ -193,70 +594,72 @@ class MeshCoreBridge:
             return template
         
         # Get IATA - broker-specific or global
-        iata = self.global_iata
-        if broker_num:
-            broker_iata = self.get_env(f'MQTT{broker_num}_IATA', '')
-            if broker_iata:
-                iata = broker_iata
+        config = self.broker_configs.get(broker_num)
+        iata = config.iata if config else self.global_iata
         
         # Replace template variables
         resolved = template.replace('{IATA}', iata)
         resolved = resolved.replace('{PUBLIC_KEY}', self.repeater_pub_key if self.repeater_pub_key else 'UNKNOWN')
         return resolved
     
-    def get_topic(self, topic_type, broker_num=None):
-        """Get topic with template resolution, checking broker-specific override first"""
-        topic_type_upper = topic_type.upper()
-        
-        # Check broker-specific topic override
-        if broker_num:
-            broker_topic = self.get_env(f'MQTT{broker_num}_TOPIC_{topic_type_upper}', '')
-            if broker_topic:
-                return self.resolve_topic_template(broker_topic, broker_num)
-        
-        # Fall back to global topic
-        global_topic = self.get_env(f'TOPIC_{topic_type_upper}', '')
-        return self.resolve_topic_template(global_topic, broker_num)
+    def _resolve_all_topics(self):
+        """Resolve every topic template once; index 0 holds the global TOPIC_* values"""
+        resolved = {0: {t: self.resolve_topic_template(self.get_env(f'TOPIC_{t.upper()}', ''))
+                        for t in TOPIC_TYPES}}
+        for broker_num, config in self.broker_configs.items():
+            resolved[broker_num] = {t: self.resolve_topic_template(template, broker_num)
+                                    for t, template in config.topic_templates.items()}
+        self.resolved_topics = resolved
+        # Flat (topic_type, broker_num) view with the global fallback already applied
+        self._topic_lookup = {(t, n): topics.get(t, resolved[0].get(t, ''))
+                              for n, topics in resolved.items() for t in TOPIC_TYPES}
 
-    def sanitize_client_id(self, name):
+    def get_topic(self, topic_type, broker_num=None):
+        """Get the pre-resolved topic, checking broker-specific override first"""
+        topic = self._topic_lookup.get((topic_type, broker_num or 0))
+        if topic is None:
+            if not self.resolved_topics:
+                self._resolve_all_topics()
+            topic = self._topic_lookup.get((topic_type, broker_num or 0),
+                                           self._topic_lookup.get((topic_type, 0), ''))
+        return topic
+
+    def sanitize_client_id(self, name, prefix=None):
         """Convert repeater name to valid MQTT client ID"""
-        prefix = self.get_env("MQTT1_CLIENT_ID_PREFIX", "meshcore_")
+        if prefix is None:
+            prefix = self.broker_configs[1].client_id_prefix
         client_id = prefix + name.replace(" ", "_")
-        client_id = re.sub(r"[^a-zA-Z0-9_-]", "", client_id)
+        # Drop non-ASCII first so the ASCII-only delete table covers everything else
+        client_id = client_id.encode('ascii', 'ignore').decode('ascii').translate(_CLIENT_ID_TRANS)
         return client_id[:23]
     
     def generate_auth_credentials(self, broker_num, force_refresh=False):
         """Generate authentication credentials for a broker on-demand"""
-        use_auth_token = self.get_env_bool(f"MQTT{broker_num}_USE_AUTH_TOKEN", False)
+        config = self.broker_configs[broker_num]
         
-        if use_auth_token:
-            if not self.repeater_priv_key:
+        if config.use_auth_token:
+            if not self.signing_key:
                 logger.error(f"[MQTT{broker_num}] Private key not available from device for auth token")
                 return None, None
             
             # Check if we have a cached token that's still fresh
-            current_time = time.time()
-            if not force_refresh and broker_num in self.token_cache:
-                cached_token, created_at = self.token_cache[broker_num]
-                age = current_time - created_at
-                if age < (self.token_ttl - 300):  # Use cached token if it has >5min remaining
-                    logger.debug(f"[MQTT{broker_num}] Using cached auth token (age: {age:.0f}s)")
-                    username = f"v1_{self.repeater_pub_key.upper()}"
-                    return username, cached_token
+            current_time = time.monotonic()
+            cached_token = None if force_refresh else self.token_cache.get(broker_num, current_time)
+            if cached_token is not None:
+                logger.debug("[MQTT%s] Using cached auth token", broker_num)
+                return self._token_username, cached_token
             
             # Generate fresh token
             try:
-                username = f"v1_{self.repeater_pub_key.upper()}"
-                audience = self.get_env(f"MQTT{broker_num}_TOKEN_AUDIENCE", "")
+                username = self._token_username
+                audience = config.token_audience
                 
                 # Security check: Only include email/owner if using TLS with verification
                 # NEVER send email/owner over plaintext or unverified connections
-                use_tls = self.get_env_bool(f"MQTT{broker_num}_USE_TLS", False)
-                tls_verify = self.get_env_bool(f"MQTT{broker_num}_TLS_VERIFY", True)
-                secure_connection = use_tls and tls_verify
+                secure_connection = config.use_tls and config.tls_verify
                 
-                owner = self.get_env(f"MQTT{broker_num}_TOKEN_OWNER", "")
-                email = self.get_env(f"MQTT{broker_num}_TOKEN_EMAIL", "")
+                owner = config.token_owner
+                email = config.token_email
                 
                 claims = {}
                 if audience:
@@ -269,22 +672,21 @@ class MeshCoreBridge:
                         claims['email'] = email.lower()
                 else:
                     if owner or email:
-                        logger.debug(f"[MQTT{broker_num}] Skipping email/owner in JWT - TLS and TLS_VERIFY must both be enabled for secure transmission")
+                        logger.debug("[MQTT%s] Skipping email/owner in JWT - TLS and TLS_VERIFY must both be enabled for secure transmission", broker_num)
                 
                 claims['client'] = self.client_version
                 
                 # Generate token with 1 hour expiry
-                password = create_auth_token(self.repeater_pub_key, self.repeater_priv_key, expiry_seconds=self.token_ttl, **claims)
-                self.token_cache[broker_num] = (password, current_time)
-                logger.debug(f"[MQTT{broker_num}] Generated fresh auth token (1h expiry)")
+                password = create_auth_token(self.repeater_pub_key, self.signing_key, expiry_seconds=self.token_ttl, **claims)
+                # Reuse the token until it has 5 minutes left
+                self.token_cache.set(broker_num, password, current_time + self.token_ttl - 300)
+                logger.debug("[MQTT%s] Generated fresh auth token (1h expiry)", broker_num)
                 return username, password
             except Exception as e:
                 logger.error(f"[MQTT{broker_num}] Failed to generate auth token: {e}")
                 return None, None
         else:
-            username = self.get_env(f"MQTT{broker_num}_USERNAME", "")
-            password = self.get_env(f"MQTT{broker_num}_PASSWORD", "")
-            return username, password
+            return config.username, config.password
 
     def connect_serial(self):
         ports = self.get_env("SERIAL_PORTS", "/dev/ttyACM0").split(",")
@@ -329,40 +731,149 @@ class MeshCoreBridge:
         finally:
             self.ser = None
 
+    def _serial_reader_loop(self):
+        """Drain the serial port into _rx_buf and queue complete lines; reconnect on errors"""
+        while not self.should_exit:
+            ser = self.ser
+            if not ser:
+                if not self.connect_serial():
+                    time.sleep(5)
+                continue
+            try:
+                data = ser.read(max(1, ser.in_waiting))
+            except (OSError, TypeError, AttributeError):
+                # TypeError/AttributeError: handle closed under us by close_serial()
+                if self.should_exit:
+                    break
+                logger.warning("Serial connection unavailable, trying to reconnect")
+                self.close_serial()
+                self.connect_serial()
+                time.sleep(0.5)
+                continue
+            if not data:
+                # Read timed out; with SERIAL_TIMEOUT=0 read() returns at once, so don't spin
+                time.sleep(0.01)
+                continue
+            
+            with self._rx_cond:
+                self._rx_buf += data
+                if self._awaiting_reply:
+                    # A command helper consumes the reply from its marker onwards
+                    self._rx_cond.notify_all()
+                    continue
+                chunk = self._pop_complete_lines()
+            self._queue_lines(chunk)
+
+    def _pop_complete_lines(self):
+        """Remove and return every complete line in _rx_buf (caller holds _rx_cond)"""
+        end = self._rx_buf.rfind(b"\n")
+        if end == -1:
+            return b""
+        chunk = bytes(self._rx_buf[:end])
+        del self._rx_buf[:end + 1]
+        return chunk
+
+    def _queue_lines(self, chunk):
+        """Hand complete lines to the main loop"""
+        if chunk:
+            for raw_line in chunk.split(b"\n"):
+                self._rx_lines.put(raw_line.decode(errors='replace').strip())
+
+    def start_serial_reader(self):
+        """Start the serial reader thread once"""
+        if self._reader_thread and self._reader_thread.is_alive():
+            return
+        self._reader_thread = threading.Thread(
+            target=self._serial_reader_loop,
+            daemon=True,
+            name="Serial-Reader"
+        )
+        self._reader_thread.start()
+
+    def _send_command(self, command, timeout=1.0):
+        """Write a CLI command and return its reply as soon as the '-> ' line is complete"""
+        with self.ser_lock:
+            with self._rx_cond:
+                # Keep lines already received; the reply is looked for past the marker
+                chunk = self._pop_complete_lines()
+                marker = len(self._rx_buf)
+                self._awaiting_reply = True
+            self._queue_lines(chunk)
+            try:
+                ser = self.ser
+                if not ser:
+                    return ""
+                ser.write(command)
+                return self._wait_for_prompt(timeout, marker, command)
+            finally:
+                with self._rx_cond:
+                    self._awaiting_reply = False
+                    chunk = self._pop_complete_lines()
+                self._queue_lines(chunk)
+
+    def _wait_for_prompt(self, timeout=1.0, marker=0, command=b""):
+        """Wait for the '-> ' reply line after marker (or timeout) and consume it.
+
+        Only the echoed command and the reply line are removed from _rx_buf; radio
+        lines arriving meanwhile (and the rest of a line cut by the marker) stay
+        there for the main loop.
+        """
+        echo = command.strip()
+        consumed = []
+        deadline = time.monotonic() + timeout
+        with self._rx_cond:
+            # Lines are scanned from the start of the line holding the marker
+            start = self._rx_buf.rfind(b"\n", 0, marker) + 1
+            while True:
+                pos = start
+                found = False
+                while True:
+                    end = self._rx_buf.find(b"\n", pos)
+                    if end == -1:
+                        break
+                    line = self._rx_buf[pos:end + 1]
+                    if pos < marker:
+                        # Completes a line that was already arriving before the command
+                        pos = end + 1
+                    elif b"-> " in line:
+                        consumed.append(bytes(line))
+                        del self._rx_buf[pos:end + 1]
+                        found = True
+                        break
+                    elif echo and line.strip() == echo:
+                        consumed.append(bytes(line))
+                        del self._rx_buf[pos:end + 1]
+                    else:
+                        pos = end + 1
+                if found:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._rx_cond.wait(remaining)
+        return b"".join(consumed).decode(errors='replace')
+
     def set_repeater_time(self):
         if not self.ser:
             return False
         
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        epoc_time = int(calendar.timegm(time.gmtime()))
+        epoc_time = int(time.time())
         timecmd=f'time {epoc_time}\r\n'
-        self.ser.write(timecmd.encode())
-        logger.debug(f"Sent '{timecmd}' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
+        logger.debug("Sent '%s' command", timecmd)
+        response = self._send_command(timecmd.encode(), 0.5)
+        logger.debug("Raw response: %r", response)
 
     def get_repeater_name(self):
         if not self.ser:
             return False
         
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"get name\r\n")
         logger.debug("Sent 'get name' command")
+        response = self._send_command(b"get name\r\n", 0.5)
+        logger.debug("Raw response: %r", response)
 
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
-
-        if "-> >" in response:
-            name = response.split("-> >")[1].strip()            
-            if '\n' in name:
-                name = name.split('\n')[0]            
-            name = name.replace('\r', '').strip()
-            self.repeater_name = name
+        match = GET_REPLY_RE.search(response)
+        if match:
+            self.repeater_name = match.group(1).strip()
             logger.info(f"Repeater name: {self.repeater_name}")
             return True
         
@@ -373,29 +884,31 @@ class MeshCoreBridge:
         if not self.ser:
             return False
         
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"get public.key\r\n")
         logger.debug("Sent 'get public.key' command")
+        response = self._send_command(b"get public.key\r\n", 1.0)
+        logger.debug("Raw response: %r", response)
 
-        sleep(1.0)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw response: {response}")
-
-        if "-> >" in response:
-            pub_key = response.split("-> >")[1].strip()            
-            if '\n' in pub_key:
-                pub_key = pub_key.split('\n')[0]            
-            pub_key_clean = pub_key.replace(' ', '').replace('\r', '').replace('\n', '')
+        match = GET_REPLY_RE.search(response)
+        if match:
+            pub_key = match.group(1)
+            pub_key_clean = pub_key.translate(_STRIP_WS)
             
             # Validate public key format (should be 64 hex characters)
-            if not pub_key_clean or len(pub_key_clean) != 64 or not all(c in '0123456789ABCDEFabcdef' for c in pub_key_clean):
+            try:
+                pub_key_bytes = bytes.fromhex(pub_key_clean)
+            except ValueError:
+                pub_key_bytes = b""
+            if len(pub_key_bytes) != 32:
                 logger.error(f"Invalid public key format: {repr(pub_key_clean)} (extracted from: {repr(pub_key)})")
                 return False
             
             # Normalize to uppercase
-            self.repeater_pub_key = pub_key_clean.upper()
+            self._repeater_pub_key_bytes = pub_key_bytes
+            self.repeater_pub_key = pub_key_bytes.hex().upper()
+            self._token_username = f"v1_{self.repeater_pub_key}"
             logger.info(f"Repeater pub key: {self.repeater_pub_key}")
+            # Topics embed {PUBLIC_KEY}: rebuild them for the (possibly new) key
+            self._resolve_all_topics()
             return True
         
         logger.error("Failed to get repeater pub key from response")
@@ -405,22 +918,14 @@ class MeshCoreBridge:
         if not self.ser:
             return False
         
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"get prv.key\r\n")
         logger.debug("Sent 'get prv.key' command")
-
-        sleep(1.0)
-        response = self.ser.read_all().decode(errors='replace')
-        if "-> >" in response:
-            priv_key = response.split("-> >")[1].strip()
-            if '\n' in priv_key:
-                priv_key = priv_key.split('\n')[0]
-
-            priv_key_clean = priv_key.replace(' ', '').replace('\r', '').replace('\n', '')
+        response = self._send_command(b"get prv.key\r\n", 1.0)
+        match = GET_REPLY_RE.search(response)
+        if match:
+            priv_key_clean = match.group(1).translate(_STRIP_WS)
             if len(priv_key_clean) == 128:
                 try:
-                    int(priv_key_clean, 16)  # Validate it's hex
+                    self._repeater_priv_key_bytes = bytes.fromhex(priv_key_clean)
                     self.repeater_priv_key = priv_key_clean
                     logger.info(f"Repeater priv key: {self.repeater_priv_key[:4]}... (truncated for security)")
                     return True
@@ -437,20 +942,14 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"get radio\r\n")
         logger.debug("Sent 'get radio' command")
+        response = self._send_command(b"get radio\r\n", 0.5)
+        logger.debug("Raw radio response: %r", response)
 
-        sleep(0.5)  # Adjust delay if necessary
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw radio response: {response}")
-
-        if "-> >" in response:
-            radio_info = response.split("-> >")[1].strip()
-            if '\n' in radio_info:
-                radio_info = radio_info.split('\n')[0]
-            logger.debug(f"Parsed radio info: {radio_info}")
+        match = GET_REPLY_RE.search(response)
+        if match:
+            radio_info = match.group(1).strip()
+            logger.debug("Parsed radio info: %s", radio_info)
             return radio_info
         
         logger.error("Failed to get radio info from response")
@@ -461,19 +960,14 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"ver\r\n")
         logger.debug("Sent 'ver' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw version response: {response}")
+        response = self._send_command(b"ver\r\n", 0.5)
+        logger.debug("Raw version response: %r", response)
 
         # Response format: "ver\n  -> 1.8.2-dev-834c700 (Build: 04-Sep-2025)\n"
-        if "-> " in response:
-            version = response.split("-> ", 1)[1]
-            version = version.split('\n')[0].replace('\r', '').strip()
+        match = REPLY_RE.search(response)
+        if match:
+            version = match.group(1).strip()
             logger.info(f"Firmware version: {version}")
             return version
         
@@ -485,19 +979,14 @@ class MeshCoreBridge:
         if not self.ser:
             return None
 
-        self.ser.reset_input_buffer()
-        self.ser.reset_output_buffer()
-        self.ser.write(b"board\r\n")
         logger.debug("Sent 'board' command")
-
-        sleep(0.5)
-        response = self.ser.read_all().decode(errors='replace')
-        logger.debug(f"Raw board response: {response}")
+        response = self._send_command(b"board\r\n", 0.5)
+        logger.debug("Raw board response: %r", response)
 
         # Response format: "board\n  -> Station G2\n"
-        if "-> " in response:
-            board_type = response.split("-> ", 1)[1]
-            board_type = board_type.split('\n')[0].replace('\r', '').strip()
+        match = REPLY_RE.search(response)
+        if match:
+            board_type = match.group(1).strip()
             if board_type == "Unknown command":
                 board_type = "unknown"
             logger.info(f"Board type: {board_type}")
@@ -514,67 +1003,44 @@ class MeshCoreBridge:
         stats = {}
         
         with self.ser_lock:
-            # Get stats-core: battery_mv, uptime_secs, errors, queue_len
-            self.ser.flushInput()
-            self.ser.flushOutput()
-            self.ser.write(b"stats-core\r\n")
-            logger.debug("Sent 'stats-core' command")
-            
-            sleep(0.5)
-            response = self.ser.read_all().decode(errors='replace')
-            logger.debug(f"Raw stats-core response: {response}")
-            
-            if "-> " in response and "Unknown command" not in response:
-                try:
-                    json_str = response.split("-> ", 1)[1].strip()
-                    json_str = json_str.split('\n')[0].replace('\r', '').strip()
-                    core_stats = json.loads(json_str)
-                    if 'battery_mv' in core_stats:
-                        stats['battery_mv'] = core_stats['battery_mv']
-                    if 'uptime_secs' in core_stats:
-                        stats['uptime_secs'] = core_stats['uptime_secs']
-                    if 'errors' in core_stats:
-                        stats['errors'] = core_stats['errors']
-                    if 'queue_len' in core_stats:
-                        stats['queue_len'] = core_stats['queue_len']
-                except (json.JSONDecodeError, ValueError) as e:
-                    logger.debug(f"Failed to parse stats-core: {e}")
-            
-            # Get stats-radio: noise_floor, tx_air_secs, rx_air_secs
-            self.ser.flushInput()
-            self.ser.flushOutput()
-            self.ser.write(b"stats-radio\r\n")
-            logger.debug("Sent 'stats-radio' command")
-            
-            sleep(0.5)
-            response = self.ser.read_all().decode(errors='replace')
-            logger.debug(f"Raw stats-radio response: {response}")
-            
-            if "-> " in response and "Unknown command" not in response:
-                try:
-                    json_str = response.split("-> ", 1)[1].strip()
-                    json_str = json_str.split('\n')[0].replace('\r', '').strip()
-                    radio_stats = json.loads(json_str)
-                    if 'noise_floor' in radio_stats:
-                        stats['noise_floor'] = radio_stats['noise_floor']
-                    if 'tx_air_secs' in radio_stats:
-                        stats['tx_air_secs'] = radio_stats['tx_air_secs']
-                    if 'rx_air_secs' in radio_stats:
-                        stats['rx_air_secs'] = radio_stats['rx_air_secs']
-                except (json.JSONDecodeError, ValueError) as e:
-                    logger.debug(f"Failed to parse stats-radio: {e}")
+            # The firmware CLI only dispatches a command when a read ends in '\r', so
+            # the two queries must stay separate writes; both run in one lock hold.
+            for command, keys in DEVICE_STATS_COMMANDS:
+                logger.debug("Sent '%s' command", command)
+                response = self._send_command(f"{command}\r\n".encode(), 0.5)
+                logger.debug("Raw %s response: %r", command, response)
+                
+                match = REPLY_RE.search(response)
+                if match and "Unknown command" not in response:
+                    try:
+                        parsed = json.loads(match.group(1))
+                        for key in keys:
+                            if key in parsed:
+                                stats[key] = parsed[key]
+                    except (json.JSONDecodeError, ValueError) as e:
+                        logger.debug("Failed to parse %s: %s", command, e)
         
         return stats
 
-    def _websocket_ping_loop(self, broker_num, mqtt_client, transport):
-        """Send WebSocket PING frames periodically to keep connection alive"""
-        if transport != "websockets":
-            return
-        
-        ping_interval = 45  # Send WebSocket ping every 45 seconds
-        
-        while broker_num in self.ws_ping_threads and self.ws_ping_threads[broker_num].get('active', False):
-            sleep(ping_interval)
+    def _websocket_keepalive_loop(self):
+        """Send WebSocket PING frames for every websockets broker from one thread"""
+        while not self.should_exit:
+            with self._ws_keepalive_cond:
+                if not self._ws_keepalive_heap:
+                    self._ws_keepalive_cond.wait()
+                    continue
+                deadline, _, broker_num, mqtt_client = self._ws_keepalive_heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    # Woken early if a broker is (un)registered
+                    self._ws_keepalive_cond.wait(delay)
+                    continue
+                if self.ws_clients.get(broker_num) is not mqtt_client:
+                    # Broker disconnected or replaced by a newer client: drop the stale entry
+                    heapq.heappop(self._ws_keepalive_heap)
+                    continue
+                heapq.heapreplace(self._ws_keepalive_heap,
+                                  (time.monotonic() + WS_PING_INTERVAL, next(self._ws_keepalive_seq), broker_num, mqtt_client))
             
             try:
                 # Access the underlying WebSocket object in paho-mqtt
@@ -583,17 +1049,39 @@ class MeshCoreBridge:
                     # Check if it's a WebSocket
                     if hasattr(sock, 'ping'):
                         sock.ping()
-                        logger.debug(f"[MQTT{broker_num}] Sent WebSocket PING")
+                        logger.debug("[MQTT%s] Sent WebSocket PING", broker_num)
             except Exception as e:
-                logger.debug(f"[MQTT{broker_num}] WebSocket PING failed: {e}")
-                # Don't break the loop - connection might recover
+                logger.debug("[MQTT%s] WebSocket PING failed: %s", broker_num, e)
+                # Keep the entry - connection might recover
+
+    def _start_websocket_keepalive(self, broker_num, mqtt_client):
+        """Schedule WebSocket pings for a broker, starting the keepalive thread on first use"""
+        with self._ws_keepalive_cond:
+            self.ws_clients[broker_num] = mqtt_client
+            heapq.heappush(self._ws_keepalive_heap,
+                           (time.monotonic() + WS_PING_INTERVAL, next(self._ws_keepalive_seq), broker_num, mqtt_client))
+            self._ws_keepalive_cond.notify()
+        
+        if not self._ws_keepalive_thread or not self._ws_keepalive_thread.is_alive():
+            self._ws_keepalive_thread = threading.Thread(
+                target=self._websocket_keepalive_loop,
+                daemon=True,
+                name="WS-Keepalive"
+            )
+            self._ws_keepalive_thread.start()
+
+    def _stop_websocket_keepalive(self, broker_num):
+        """Stop WebSocket pings for a broker; its heap entry is dropped when it comes due"""
+        with self._ws_keepalive_cond:
+            if self.ws_clients.pop(broker_num, None) is not None:
+                logger.debug("[MQTT%s] Stopped WebSocket keepalive", broker_num)
     
     def _stats_logging_loop(self):
         """Log statistics every 5 minutes"""
         stats_interval = 300
         
         while not self.should_exit:
-            sleep(stats_interval)
+            time.sleep(stats_interval)
             
             if self.should_exit:
                 break
@@ -602,60 +1090,45 @@ class MeshCoreBridge:
             logger.debug("[STATS] Fetching fresh device stats from serial...")
             device_stats = self.get_device_stats()
             if device_stats:
-                self.stats['device'] = device_stats
-                logger.debug(f"[STATS] Updated device stats: {device_stats}")
+                self.stats.device = device_stats
+                self._status_payload_cache = (None, b'')
+                logger.debug("[STATS] Updated device stats: %s", device_stats)
                 # Publish updated status with new stats
                 self.publish_status("online")
             else:
                 logger.debug("[STATS] No device stats received")
             
             # Calculate uptime
-            uptime_seconds = int(time.time() - self.stats['start_time'])
-            uptime_hours = uptime_seconds // 3600
-            uptime_minutes = (uptime_seconds % 3600) // 60
-            
-            if uptime_hours > 0:
-                uptime_str = f"{uptime_hours}h {uptime_minutes}m"
-            else:
-                uptime_str = f"{uptime_minutes}m"
+            uptime_str = format_uptime(int(time.monotonic() - self.stats.start_time))
             
             # Calculate data volume with appropriate units
-            bytes_actual = self.stats['bytes_processed']
-            if bytes_actual < 1024:
-                data_str = f"{bytes_actual}B"
-            elif bytes_actual < 1024 * 1024:
-                data_str = f"{bytes_actual / 1024:.1f}KB"
-            elif bytes_actual < 1024 * 1024 * 1024:
-                data_str = f"{bytes_actual / (1024 * 1024):.1f}MB"
-            else:
-                data_str = f"{bytes_actual / (1024 * 1024 * 1024):.2f}GB"
+            data_str = format_bytes(self.stats.bytes_processed)
             
             total_brokers = len(self.mqtt_clients)
             connected_brokers = sum(1 for info in self.mqtt_clients if info.get('connected', False))
             
             # Calculate packets per minute over the last interval (5 minutes)
-            time_elapsed = time.time() - self.stats['last_stats_log']
-            packets_rx_delta = self.stats['packets_rx'] - self.stats['packets_rx_prev']
-            packets_tx_delta = self.stats['packets_tx'] - self.stats['packets_tx_prev']
+            time_elapsed = time.monotonic() - self.stats.last_stats_log
+            packets_rx_delta = self.stats.packets_rx - self.stats.packets_rx_prev
+            packets_tx_delta = self.stats.packets_tx - self.stats.packets_tx_prev
             packets_per_min = ((packets_rx_delta + packets_tx_delta) / time_elapsed) * 60 if time_elapsed > 0 else 0
             
             # Store current counts for next interval
-            self.stats['packets_rx_prev'] = self.stats['packets_rx']
-            self.stats['packets_tx_prev'] = self.stats['packets_tx']
+            self.stats.packets_rx_prev = self.stats.packets_rx
+            self.stats.packets_tx_prev = self.stats.packets_tx
             
             # Prune reconnect timestamps older than 24 hours and build reconnect stats
-            current_time = time.time()
-            cutoff_time = current_time - 86400  # 24 hours in seconds
+            cutoff_time = time.monotonic() - 86400  # 24 hours in seconds
             reconnect_stats = []
             
-            for broker_num in sorted(self.stats['reconnects'].keys()):
-                # Prune old timestamps
-                self.stats['reconnects'][broker_num] = [
-                    ts for ts in self.stats['reconnects'][broker_num] if ts > cutoff_time
-                ]
+            for broker_num in sorted(self.stats.reconnects.keys()):
+                # Prune old timestamps (oldest first, so stop at the first recent one)
+                reconnects = self.stats.reconnects[broker_num]
+                while reconnects and reconnects[0] <= cutoff_time:
+                    reconnects.popleft()
                 
                 # Count reconnects in last 24 hours
-                reconnect_count = len(self.stats['reconnects'][broker_num])
+                reconnect_count = len(reconnects)
                 if reconnect_count > 0:
                     reconnect_stats.append(f"MQTT{broker_num}:{reconnect_count}")
             
@@ -663,17 +1136,14 @@ class MeshCoreBridge:
             
             # Log the main stats
             logger.info(
-                f"[SERVICE] Uptime: {uptime_str} | "
-                f"RX/TX: {self.stats['packets_rx']}/{self.stats['packets_tx']} (5m: {packets_per_min:.1f}/min) | "
-                f"RX bytes: {data_str} | "
-                f"MQTT: {connected_brokers}/{total_brokers} | "
-                f"Reconnects/24h: {reconnect_str} | "
-                f"Failures: {self.stats['publish_failures']}"
+                self._stats_fmt,
+                uptime_str, self.stats.packets_rx, self.stats.packets_tx, packets_per_min, data_str,
+                connected_brokers, total_brokers, reconnect_str, self.stats.publish_failures
             )
             
-            # Log device stats separately if available
-            if self.stats['device']:
-                ds = self.stats['device']
+            # Log device stats separately if available (skipped entirely when INFO is filtered)
+            if self.stats.device and logger.isEnabledFor(logging.INFO):
+                ds = self.stats.device
                 parts = []
                 
                 if 'noise_floor' in ds:
@@ -686,7 +1156,7 @@ class MeshCoreBridge:
                     uptime_secs = ds['uptime_secs']
                     
                     # Calculate delta from previous reading
-                    prev = self.stats.get('device_prev', {})
+                    prev = self.stats.device_prev
                     if prev and 'tx_air_secs' in prev and 'rx_air_secs' in prev and 'uptime_secs' in prev:
                         # Delta calculation (airtime since last reading)
                         tx_delta = tx_secs_total - prev['tx_air_secs']
@@ -711,16 +1181,7 @@ class MeshCoreBridge:
                 
                 # Device uptime
                 if 'uptime_secs' in ds:
-                    dev_uptime_secs = ds['uptime_secs']
-                    dev_uptime_hours = dev_uptime_secs // 3600
-                    dev_uptime_minutes = (dev_uptime_secs % 3600) // 60
-                    
-                    if dev_uptime_hours > 0:
-                        dev_uptime_str = f"{dev_uptime_hours}h {dev_uptime_minutes}m"
-                    else:
-                        dev_uptime_str = f"{dev_uptime_minutes}m"
-                    
-                    parts.append(f"Uptime: {dev_uptime_str}")
+                    parts.append("Uptime: " + format_uptime(ds['uptime_secs']))
                 
                 # Errors
                 if 'errors' in ds:
@@ -731,43 +1192,44 @@ class MeshCoreBridge:
                     parts.append(f"Queue: {ds['queue_len']}")
                 
                 if parts:
-                    logger.info(f"[DEVICE] {' | '.join(parts)}")
+                    logger.info("[DEVICE] %s", " | ".join(parts))
             
             # Save current device stats as previous for next interval calculation
-            if self.stats['device']:
-                self.stats['device_prev'] = self.stats['device'].copy()
+            if self.stats.device:
+                self.stats.device_prev = self.stats.device.copy()
             
-            self.stats['last_stats_log'] = time.time()
+            self.stats.last_stats_log = time.monotonic()
     
     def on_mqtt_connect(self, client, userdata, flags, rc, properties=None):
         broker_name = userdata.get('name', 'unknown') if userdata else 'unknown'
         broker_num = userdata.get('broker_num', None) if userdata else None
         
         # Signal that this broker has completed its connection attempt
-        if broker_num in self.connection_events:
-            self.connection_events[broker_num].set()
+        connection_future = self.connection_events.get(broker_num)
+        if connection_future and not connection_future.done():
+            connection_future.set_result(rc)
         
         if rc == 0:
             # Reset reconnect delay on successful connection
             self.reconnect_delay = 1.0
             
             # Find the mqtt_info for this broker
-            mqtt_info = None
-            for info in self.mqtt_clients:
-                if info['broker_num'] == broker_num:
-                    mqtt_info = info
-                    break
+            mqtt_info = self._clients_by_num.get(broker_num)
             
             if not mqtt_info:
                 logger.error(f"[MQTT{broker_num}] on_connect fired but broker not in mqtt_clients list")
                 return
             
-            current_time = time.time()
-            was_connected = mqtt_info.get('connected', False)
+            current_time = time.monotonic()
             is_first_connect = mqtt_info.get('connect_time', 0) == 0
             
-            # Set connected state
-            mqtt_info['connected'] = True
+            # Set connected state and track the global flag
+            with self._connected_lock:
+                was_connected = mqtt_info.get('connected', False)
+                mqtt_info['connected'] = True
+                if not was_connected:
+                    self._connected_count += 1
+                self.mqtt_connected = True
             mqtt_info['connecting_since'] = 0  # Clear connecting timestamp
             mqtt_info['connect_time'] = current_time
             
@@ -777,20 +1239,13 @@ class MeshCoreBridge:
                 logger.info(f"[MQTT{broker_num}] Connected to broker")
             else:
                 # was_connected=False but connect_time > 0 means we already logged this connection
-                logger.debug(f"[MQTT{broker_num}] Connection state updated")
-            
-            # Track global connected state
-            if not self.mqtt_connected:
-                self.mqtt_connected = True
+                logger.debug("[MQTT%s] Connection state updated", broker_num)
             
             # Publish online status
             status_topic = self.get_topic("status", broker_num)
-            status_payload = json.dumps(self.build_status_message("online"))
-            qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
-            retain = self.get_env_bool(f"MQTT{broker_num}_RETAIN", True)
-            
+            status_payload = self.status_payload("online")
             try:
-                result = client.publish(status_topic, status_payload, qos=qos, retain=retain)
+                result = client.publish(status_topic, status_payload, qos=mqtt_info['qos'], retain=mqtt_info['retain'])
                 if result.rc == mqtt.MQTT_ERR_SUCCESS:
                     # Only reset failed_attempts if we had a previous successful connection
                     # that lasted >= 120 seconds. This prevents rapid connect/disconnect cycles
@@ -803,134 +1258,211 @@ class MeshCoreBridge:
             logger.error(f"[MQTT{broker_num}] Connection failed with code: {rc}")
 
 
+    def on_mqtt_connect_fail(self, client, userdata):
+        broker_num = userdata.get('broker_num', None) if userdata else None
+        logger.warning(f"[MQTT{broker_num}] Connection attempt failed")
+        
+        # Fail the pending initial-connection future instead of letting it time out
+        connection_future = self.connection_events.get(broker_num)
+        if connection_future and not connection_future.done():
+            connection_future.set_exception(ConnectionError(f"MQTT{broker_num} connection failed"))
+
     def on_mqtt_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         broker_name = userdata.get('name', 'unknown') if userdata else 'unknown'
         broker_num = userdata.get('broker_num', None) if userdata else None
 
-        # Stop WebSocket ping thread per questo broker
-        if broker_num in self.ws_ping_threads:
-            self.ws_ping_threads[broker_num]['active'] = False
+        # Stop WebSocket keepalive per questo broker
+        self._stop_websocket_keepalive(broker_num)
 
-        mqtt_info = None
-        for info in self.mqtt_clients:
-            if info['broker_num'] == broker_num:
-                mqtt_info = info
-                break
+        mqtt_info = self._clients_by_num.get(broker_num)
 
         if mqtt_info is None:
             logger.warning(f"[MQTT{broker_num}] Disconnected, but broker info not found")
             return
 
-        already_disconnected = not mqtt_info.get('connected', False)
-
         # Marca come disconnesso e programma una riconnessione semplice
-        mqtt_info['connected'] = False
+        with self._connected_lock:
+            already_disconnected = not mqtt_info.get('connected', False)
+            mqtt_info['connected'] = False
+            if not already_disconnected:
+                self._connected_count -= 1
+            # Se TUTTI i broker sono disconnessi, aggiorna flag globale
+            self.mqtt_connected = self._connected_count > 0
         mqtt_info['connecting_since'] = 0
 
         # Riconnessione dopo un piccolo delay (usiamo self.reconnect_delay ma senza contatori “short-lived”)
-        mqtt_info['reconnect_at'] = time.time() + self.reconnect_delay
+        mqtt_info['reconnect_at'] = time.monotonic() + self.reconnect_delay
 
         if not already_disconnected:
             logger.warning(f"[MQTT{broker_num}] Disconnected (code: {reason_code}, flags: {disconnect_flags}, properties: {properties})")
 
             # Tracciamo l'evento solo per statistiche
-            current_time = time.time()
-            if broker_num not in self.stats['reconnects']:
-                self.stats['reconnects'][broker_num] = []
-            self.stats['reconnects'][broker_num].append(current_time)
-
-        # Se TUTTI i broker sono disconnessi, aggiorna flag globale
-        all_disconnected = all(not info.get('connected', False) for info in self.mqtt_clients)
-        if all_disconnected:
-            self.mqtt_connected = False
+            self.stats.reconnects[broker_num].append(int(time.monotonic()))
 
 
     def build_status_message(self, status, include_stats=True):
         """Build a status message with all required fields"""
+        # Device identity only changes during startup queries; rebuild it when it does
+        static_key = (self.repeater_name, self.repeater_pub_key, self.radio_info, self.model, self.firmware_version)
+        if static_key != self._status_static_key:
+            self._status_static_key = static_key
+            self._status_static = {
+                "origin": self.repeater_name,
+                "origin_id": self.repeater_pub_key,
+                "radio": self.radio_info if self.radio_info else "unknown",
+                "model": self.model if self.model else "unknown",
+                "firmware_version": self.firmware_version if self.firmware_version else "unknown",
+                "client_version": self.client_version
+            }
+        
         message = {
             "status": status,
-            "timestamp": datetime.now().isoformat(),
-            "origin": self.repeater_name,
-            "origin_id": self.repeater_pub_key,
-            "radio": self.radio_info if self.radio_info else "unknown",
-            "model": self.model if self.model else "unknown",
-            "firmware_version": self.firmware_version if self.firmware_version else "unknown",
-            "client_version": self.client_version
+            "timestamp": iso_now(),
+            **self._status_static
         }
         
         # Add device stats if available and requested
-        if include_stats and self.stats['device']:
-            message['stats'] = self.stats['device']
+        if include_stats and self.stats.device:
+            message['stats'] = self.stats.device
         
         return message
+
+    def status_payload(self, status):
+        """Serialized status message; re-encoded only when status, identity or stats change"""
+        key = (status, id(self.stats.device), self.repeater_name, self.repeater_pub_key,
+               self.radio_info, self.model, self.firmware_version)
+        cached_key, template = self._status_payload_cache
+        if key != cached_key:
+            message = self.build_status_message(status)
+            message['timestamp'] = STATUS_TS_PLACEHOLDER
+            template = dumps_json(message)
+            self._status_payload_cache = (key, template)
+        # "timestamp" precedes every user-supplied field, so the first hit is always ours
+        return template.replace(STATUS_TS_PLACEHOLDER_BYTES, iso_now().encode(), 1)
     
     def publish_status(self, status, client=None, broker_num=None):
         """Publish online status with stats (NOT retained)"""
-        status_msg = self.build_status_message(status, include_stats=True)
         status_topic = self.get_topic("status", broker_num)
+        payload = self.status_payload(status)
         
         if client:
-            self.safe_publish(status_topic, json.dumps(status_msg), retain=False, client=client, broker_num=broker_num)
+            self.safe_publish(status_topic, payload, retain=False, client=client, broker_num=broker_num)
         else:
-            self.safe_publish(status_topic, json.dumps(status_msg), retain=False)
+            self.safe_publish(status_topic, payload, retain=False)
         
-        logger.debug(f"Published status: {status}")
+        logger.debug("Published status: %s", status)
 
-    def safe_publish(self, topic, payload, retain=False, client=None, broker_num=None):
-        """Publish to one or all MQTT brokers"""
+    def safe_publish(self, topic, payload, retain=False, client=None, broker_num=None, batch=False):
+        """Publish to one or all MQTT brokers; batch=True lets batching brokers coalesce it"""
         if not self.mqtt_connected:
             logger.warning(f"Not connected - skipping publish to {topic}")
-            self.stats['publish_failures'] += 1
+            self.stats.publish_failures += 1
             return False
 
         success = False
         
         if client:
-            clients_to_publish = [info for info in self.mqtt_clients if info['client'] == client]
+            client_info = self._clients_by_obj.get(id(client))
+            clients_to_publish = [client_info] if client_info else []
         else:
             clients_to_publish = self.mqtt_clients
         
         for mqtt_client_info in clients_to_publish:
             broker_num = mqtt_client_info['broker_num']
-            try:
-                mqtt_client = mqtt_client_info['client']
-                qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
-                if qos == 1:
-                    qos = 0  # force qos=1 to 0 because qos 1 can cause retry storms
-                
-                result = mqtt_client.publish(topic, payload, qos=qos, retain=retain)
-                if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                    logger.error(f"[MQTT{broker_num}] Publish failed to {topic}: {mqtt.error_string(result.rc)}")
-                    self.stats['publish_failures'] += 1
-                else:
-                    logger.debug(f"[MQTT{broker_num}] Published to {topic}")
-                    success = True
-            except Exception as e:
-                logger.error(f"[MQTT{broker_num}] Publish error to {topic}: {str(e)}")
-                self.stats['publish_failures'] += 1
+            batcher = self._batchers.get(broker_num) if batch else None
+            if batcher and not retain:
+                # Only the packet/debug streams are batched: status always goes out unframed
+                batcher.add(topic, payload.encode() if isinstance(payload, str) else payload)
+                success = True
+                continue
+            if self._publish_to(mqtt_client_info, topic, payload, retain):
+                success = True
         
         return success
 
+    def _publish_packet(self, topic, payload):
+        """safe_publish for the packet stream: bytes to every broker, never retained"""
+        if not self.mqtt_connected:
+            logger.warning(f"Not connected - skipping publish to {topic}")
+            self.stats.publish_failures += 1
+            return
+        for route in self._packet_routes:
+            route(topic, payload)
+
+    def _publish_to(self, mqtt_client_info, topic, payload, retain=False):
+        """Publish one message to a single broker"""
+        broker_num = mqtt_client_info['broker_num']
+        try:
+            result = mqtt_client_info['client'].publish(topic, payload, qos=mqtt_client_info['qos'], retain=retain)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error(f"[MQTT{broker_num}] Publish failed to {topic}: {mqtt.error_string(result.rc)}")
+                self.stats.publish_failures += 1
+                return False
+            logger.debug("[MQTT%s] Published to %s", broker_num, topic)
+            return True
+        except Exception as e:
+            logger.error(f"[MQTT{broker_num}] Publish error to {topic}: {str(e)}")
+            self.stats.publish_failures += 1
+            return False
+
+    def _publish_batch(self, broker_num, topic, payload, count):
+        """Publish one coalesced batch to a broker, tagged with MQTT 5 user properties"""
+        mqtt_client_info = self._clients_by_num.get(broker_num)
+        if not mqtt_client_info or not mqtt_client_info.get('connected', False):
+            logger.warning("[MQTT%s] Not connected - dropping batch of %s to %s", broker_num, count, topic)
+            self.stats.publish_failures += count
+            return False
+        
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.UserProperty = [("batch-format", "v1"), ("batch-size", str(count))]
+        
+        try:
+            result = mqtt_client_info['client'].publish(topic, payload, qos=mqtt_client_info['qos'], retain=False,
+                                                        properties=properties)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error(f"[MQTT{broker_num}] Batch publish failed to {topic}: {mqtt.error_string(result.rc)}")
+                self.stats.publish_failures += count
+                return False
+        except Exception as e:
+            logger.error(f"[MQTT{broker_num}] Batch publish error to {topic}: {str(e)}")
+            self.stats.publish_failures += count
+            return False
+        
+        logger.debug("[MQTT%s] Published batch of %s to %s", broker_num, count, topic)
+        return True
+
     def _create_mqtt_client(self, broker_num):
         """
         Crea e configura un client MQTT (non lo connette).
         Versione semplificata, senza will_set per evitare errori di topic non valido.
         """
+        config = self.broker_configs[broker_num]
+
         # client_id basato su pubkey (sanitizzato)
         base_id = self.repeater_pub_key or f"repeater_{broker_num}"
-        client_id = self.sanitize_client_id(base_id)
+        client_id = self.sanitize_client_id(base_id, config.client_id_prefix)
         if broker_num > 1:
             client_id += f"_{broker_num}"
 
-        transport = self.get_env(f"MQTT{broker_num}_TRANSPORT", "tcp")
+        transport = config.transport
 
-        mqtt_client = mqtt.Client(
-            client_id=client_id,
-            clean_session=True,
-            transport=transport,
-            reconnect_on_failure=False,
-            callback_api_version=mqtt.CallbackAPIVersion.VERSION2
-        )
+        if config.batch_enabled:
+            # User properties on batched publishes need MQTT 5 (clean_session is v3-only)
+            mqtt_client = mqtt.Client(
+                client_id=client_id,
+                protocol=mqtt.MQTTv5,
+                transport=transport,
+                reconnect_on_failure=False,
+                callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+            )
+        else:
+            mqtt_client = mqtt.Client(
+                client_id=client_id,
+                clean_session=True,
+                transport=transport,
+                reconnect_on_failure=False,
+                callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+            )
 
         mqtt_client.user_data_set({
             "name": f"MQTT{broker_num}",
@@ -948,27 +1480,26 @@ class MeshCoreBridge:
         # LWT: per ora DISABILITATO per evitare ValueError se il topic è vuoto/errato
         lwt_topic = self.get_topic("status", broker_num)
         if lwt_topic:
-            lwt_payload = json.dumps(self.build_status_message("offline", include_stats=False))
-            lwt_qos = self.get_env_int(f"MQTT{broker_num}_QOS", 0)
-            lwt_retain = self.get_env_bool(f"MQTT{broker_num}_RETAIN", True)
+            lwt_payload = dumps_json(self.build_status_message("offline", include_stats=False))
+            lwt_qos = config.qos
+            lwt_retain = config.retain
             # Se in futuro vuoi riattivarlo, togli i commenti e aggiungi try/except:
             # try:
             #     mqtt_client.will_set(lwt_topic, lwt_payload, qos=lwt_qos, retain=lwt_retain)
             # except ValueError as e:
             #     logger.warning(f"[MQTT{broker_num}] LWT disabilitato (topic non valido: {lwt_topic!r}): {e}")
         else:
-            logger.debug(f"[MQTT{broker_num}] Nessun topic STATUS configurato, LWT non impostato")
+            logger.debug("[MQTT%s] Nessun topic STATUS configurato, LWT non impostato", broker_num)
 
         # Callback
         mqtt_client.on_connect = self.on_mqtt_connect
+        mqtt_client.on_connect_fail = self.on_mqtt_connect_fail
         mqtt_client.on_disconnect = self.on_mqtt_disconnect
 
         # TLS
-        use_tls = self.get_env_bool(f"MQTT{broker_num}_USE_TLS", False)
-        if use_tls:
+        if config.use_tls:
             import ssl
-            tls_verify = self.get_env_bool(f"MQTT{broker_num}_TLS_VERIFY", True)
-            if tls_verify:
+            if config.tls_verify:
                 mqtt_client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
                 mqtt_client.tls_insecure_set(False)
             else:
@@ -995,22 +1526,23 @@ class MeshCoreBridge:
             logger.error("[MQTT] Cannot connect without repeater name")
             return None
 
-        if not self.get_env_bool(f"MQTT{broker_num}_ENABLED", False):
-            logger.debug(f"[MQTT{broker_num}] Disabled, skipping")
+        config = self.broker_configs[broker_num]
+        if not config.enabled:
+            logger.debug("[MQTT%s] Disabled, skipping", broker_num)
             return None
 
         # Get config
-        server = self.get_env(f"MQTT{broker_num}_SERVER", "")
+        server = config.server
         if not server:
             logger.error(f"[MQTT{broker_num}] No server configured")
             return None
         
-        port = self.get_env_int(f"MQTT{broker_num}_PORT", 1883)
-        transport = self.get_env(f"MQTT{broker_num}_TRANSPORT", "tcp")
-        keepalive = self.get_env_int(f"MQTT{broker_num}_KEEPALIVE", 60)
-        use_tls = self.get_env_bool(f"MQTT{broker_num}_USE_TLS", False)
+        port = config.port
+        transport = config.transport
+        keepalive = config.keepalive
+        use_tls = config.use_tls
         
-        logger.debug(f"[MQTT{broker_num}] Creating fresh client")
+        logger.debug("[MQTT%s] Creating fresh client", broker_num)
         
         # Create client
         mqtt_client = self._create_mqtt_client(broker_num)
@@ -1022,16 +1554,9 @@ class MeshCoreBridge:
             mqtt_client.connect(server, port, keepalive=keepalive)
             mqtt_client.loop_start()
             
-            # Start WebSocket ping thread if needed
+            # Schedule WebSocket pings if needed
             if transport == "websockets":
-                self.ws_ping_threads[broker_num] = {'active': True}
-                ping_thread = threading.Thread(
-                    target=self._websocket_ping_loop,
-                    args=(broker_num, mqtt_client, transport),
-                    daemon=True,
-                    name=f"WS-Ping-MQTT{broker_num}"
-                )
-                ping_thread.start()
+                self._start_websocket_keepalive(broker_num, mqtt_client)
             
             logger.info(f"[MQTT{broker_num}] Connecting to {server}:{port} (transport={transport}, tls={use_tls}, keepalive={keepalive}s)")
             
@@ -1041,53 +1566,79 @@ class MeshCoreBridge:
                 'server': server,
                 'port': port,
                 'connected': False,
-                'connecting_since': time.time(),
+                'connecting_since': time.monotonic(),
                 'connect_time': 0,
                 'reconnect_at': 0,
-                'failed_attempts': 0
+                'failed_attempts': 0,
+                'qos': config.qos,
+                'retain': config.retain
             }
         except Exception as e:
             logger.error(f"[MQTT{broker_num}] Failed to connect: {e}")
             return None
 
+    def _index_client(self, client_info, replaces=None):
+        """Keep the broker_num / client lookups in step with self.mqtt_clients"""
+        if replaces is not None:
+            self._clients_by_obj.pop(id(replaces['client']), None)
+            with self._connected_lock:
+                # The old client may have connected after it was picked for replacement
+                if replaces.get('connected', False):
+                    replaces['connected'] = False
+                    self._connected_count -= 1
+                    self.mqtt_connected = self._connected_count > 0
+        self._clients_by_num[client_info['broker_num']] = client_info
+        self._clients_by_obj[id(client_info['client'])] = client_info
+        
+        # Resolve the safe_publish branches for the packet stream once per client change
+        routes = []
+        for mqtt_client_info in self.mqtt_clients:
+            broker_num = mqtt_client_info['broker_num']
+            if broker_num in self._batchers:
+                routes.append(self._batchers[broker_num].add)
+            else:
+                routes.append(partial(self._publish_to, mqtt_client_info))
+        self._packet_routes = routes
+
     def connect_mqtt(self):
         """Initial connection to all configured MQTT brokers"""
 
         # 🔧 PULIZIA STATO PRIMA DI OGNI TENTATIVO
         # azzero la lista client e gli eventi, altrimenti ai retry si accumulano
         self.mqtt_clients = []
+        self._clients_by_num = {}
+        self._clients_by_obj = {}
+        self._packet_routes = []
         self.connection_events = {}
-        self.mqtt_connected = False
+        with self._connected_lock:
+            self._connected_count = 0
+            self.mqtt_connected = False
 
-        logger.debug("=== MQTT Broker Configuration ===")
-        for broker_num in range(1, 5):
-            enabled = self.get_env_bool(f"MQTT{broker_num}_ENABLED", False)
-            if enabled:
-                server = self.get_env(f"MQTT{broker_num}_SERVER", "")
-                port = self.get_env_int(f"MQTT{broker_num}_PORT", 1883)
-                transport = self.get_env(f"MQTT{broker_num}_TRANSPORT", "tcp")
-                use_tls = self.get_env_bool(f"MQTT{broker_num}_USE_TLS", False)
-                use_auth_token = self.get_env_bool(f"MQTT{broker_num}_USE_AUTH_TOKEN", False)
-
-                if server:
-                    logger.debug(
-                        f"[MQTT{broker_num}] ENABLED - {server}:{port} "
-                        f"(transport={transport}, tls={use_tls}, auth_token={use_auth_token})"
-                    )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("=== MQTT Broker Configuration ===")
+            for broker_num, config in self.broker_configs.items():
+                if config.enabled:
+                    if config.server:
+                        logger.debug(
+                            "[MQTT%s] ENABLED - %s:%s (transport=%s, tls=%s, auth_token=%s)",
+                            broker_num, config.server, config.port,
+                            config.transport, config.use_tls, config.use_auth_token
+                        )
+                    else:
+                        logger.debug("[MQTT%s] DISABLED (no server configured)", broker_num)
                 else:
-                    logger.debug(f"[MQTT{broker_num}] DISABLED (no server configured)")
-            else:
-                logger.debug(f"[MQTT{broker_num}] DISABLED")
-        logger.debug("=================================")
+                    logger.debug("[MQTT%s] DISABLED", broker_num)
+            logger.debug("=================================")
 
         
         # Connect to all enabled brokers
         for broker_num in range(1, 5):
-            self.connection_events[broker_num] = threading.Event()
+            self.connection_events[broker_num] = Future()
             
             client_info = self.create_and_connect_broker(broker_num)
             if client_info:
                 self.mqtt_clients.append(client_info)
+                self._index_client(client_info)
         
         if len(self.mqtt_clients) == 0:
             logger.error("[MQTT] Failed to connect to any broker")
@@ -1095,44 +1646,27 @@ class MeshCoreBridge:
         
         logger.info(f"[MQTT] Initiated connection to {len(self.mqtt_clients)} broker(s)")
         
-        # Wait for all brokers to complete initial connection attempt
-        max_wait = 10  # seconds per broker
-        for mqtt_info in self.mqtt_clients:
-            broker_num = mqtt_info['broker_num']
-            event = self.connection_events.get(broker_num)
-            if event:
-                event.wait(timeout=max_wait)
+        # Wait for all brokers to complete initial connection attempt (in parallel)
+        max_wait = 10  # seconds
+        pending = [self.connection_events[info['broker_num']] for info in self.mqtt_clients]
+        futures_wait(pending, timeout=max_wait, return_when=ALL_COMPLETED)
         
         # ✅ Controlla se almeno un broker risulta connesso
-        any_connected = any(info.get('connected', False) for info in self.mqtt_clients)
-
-        if not any_connected:
+        if not self.mqtt_connected:
             logger.error("[MQTT] No brokers connected after initial connection attempts")
             return False
 
-        # Allinea anche il flag globale
-        self.mqtt_connected = True
         logger.info(f"[MQTT] At least one broker connected OK")
         return True
 
     
-    def _stop_websocket_ping_thread(self, broker_num):
-        """Cleanly stop the WebSocket ping thread for a broker"""
-        if broker_num in self.ws_ping_threads:
-            self.ws_ping_threads[broker_num]['active'] = False
-            # Give thread a moment to exit cleanly
-            time.sleep(0.1)
-            # Remove from dict to prevent memory leak
-            del self.ws_ping_threads[broker_num]
-            logger.debug(f"[MQTT{broker_num}] Stopped WebSocket ping thread")
-    
     def reconnect_disconnected_brokers(self):
         """
         Check for disconnected brokers and recreate them.
         Simple: throw away old client, create fresh one.
         Exit after max_reconnect_attempts consecutive failures per broker.
         """
-        current_time = time.time()
+        current_time = time.monotonic()
         
         for i, mqtt_info in enumerate(self.mqtt_clients):
             # Skip if already connected
@@ -1166,17 +1700,16 @@ class MeshCoreBridge:
             old_client = mqtt_info.get('client')
             if old_client:
                 try:
-                    # Stop WebSocket ping thread cleanly
-                    self._stop_websocket_ping_thread(broker_num)
+                    # Stop WebSocket keepalive for the old client
+                    self._stop_websocket_keepalive(broker_num)
                     # Stop paho loop and disconnect
                     old_client.loop_stop()
                     old_client.disconnect()
                 except Exception as e:
-                    logger.debug(f"[MQTT{broker_num}] Error stopping old client: {e}")
+                    logger.debug("[MQTT%s] Error stopping old client: %s", broker_num, e)
             
             # Clear token cache to force fresh token
-            if broker_num in self.token_cache:
-                del self.token_cache[broker_num]
+            self.token_cache.pop(broker_num)
             
             # Create fresh client
             new_client_info = self.create_and_connect_broker(broker_num)
@@ -1184,7 +1717,8 @@ class MeshCoreBridge:
             if new_client_info:
                 # Success - replace old client
                 self.mqtt_clients[i] = new_client_info
-                logger.debug(f"[MQTT{broker_num}] Recreated client successfully")
+                self._index_client(new_client_info, replaces=mqtt_info)
+                logger.debug("[MQTT%s] Recreated client successfully", broker_num)
             else:
                 # Failure - increment counter and schedule retry
                 mqtt_info['failed_attempts'] = failed_attempts + 1
@@ -1197,45 +1731,44 @@ class MeshCoreBridge:
     def parse_and_publish(self, line):
         if not line:
             return
-        logger.debug(f"From Radio: {line}")
-        message = {
-            "origin": self.repeater_name,
-            "origin_id": self.repeater_pub_key,
-            "timestamp": datetime.now().isoformat()
-        }
+        logger.debug("From Radio: %s", line)
 
-        # Handle RAW messages
-        if "U RAW:" in line:
-            parts = line.split("U RAW:")
-            if len(parts) > 1:
-                raw_hex = parts[1].strip()
-                self.last_raw = raw_hex
-                # Count actual bytes (hex string is 2x the actual byte count)
-                self.stats['bytes_processed'] += len(raw_hex) // 2
-
-        # Handle DEBUG messages
-        if self.debug:
-            if line.startswith("DEBUG"):
-                message.update({
-                    "type": "DEBUG",
-                    "message": line
-                })
-                debug_topic = self.get_topic("debug")
-                if debug_topic:
-                    self.safe_publish(debug_topic, json.dumps(message))
+        packet_match = LINE_PATTERN.match(line)
+        if packet_match:
+            # Handle RAW messages
+            raw_hex = packet_match.group(8)
+            if raw_hex is not None:
+                try:
+                    self.last_raw_bytes = bytes.fromhex(raw_hex)
+                except ValueError:
+                    logger.debug("Ignoring malformed RAW line: %s", line)
+                    return
+                self.stats.bytes_processed += len(self.last_raw_bytes)
                 return
 
-        # Handle Packet messages (RX and TX)
-        packet_match = PACKET_PATTERN.match(line)
-        if packet_match:
+            # Handle Packet messages (RX and TX)
             direction = packet_match.group(3).lower()  # rx or tx
             
             # Update packet counters
             if direction == "rx":
-                self.stats['packets_rx'] += 1
+                self.stats.packets_rx += 1
             else:
-                self.stats['packets_tx'] += 1
+                self.stats.packets_tx += 1
             
+            tail = PACKET_TAIL.match(line, packet_match.end()) if direction == "rx" else None
+            packets_topic = self.get_topic("packets")
+            if not packets_topic:
+                return
+
+            if self.packet_encoding == 'binary':
+                try:
+                    self._publish_packet(packets_topic, encode_packet_binary(
+                        packet_match, tail.groups() if tail else None, self.repeater_name,
+                        self._repeater_pub_key_bytes, self.last_raw_bytes))
+                    return
+                except ValueError as e:
+                    logger.debug("Packet not representable in binary (%s), sending JSON", e)
+
             packet_type = packet_match.group(5)
             payload = {
                 "type": "PACKET",
@@ -1251,24 +1784,43 @@ class MeshCoreBridge:
 
             # Add SNR, RSSI, score, and hash for RX packets
             if direction == "rx":
+                snr, rssi, score, duration, packet_hash, path = tail.groups() if tail else (None,) * 6
                 payload.update({
-                    "SNR": packet_match.group(8),
-                    "RSSI": packet_match.group(9),
-                    "score": packet_match.group(10),
-                    "duration": packet_match.group(12),
-                    "hash": packet_match.group(13)
+                    "SNR": snr,
+                    "RSSI": rssi,
+                    "score": score,
+                    "duration": duration,
+                    "hash": packet_hash
                 })
 
                 # Add path for route=D
-                if packet_match.group(6) == "D" and packet_match.group(14):
-                    payload["path"] = packet_match.group(14)
-
-            message.update(payload)
-            packets_topic = self.get_topic("packets")
-            if packets_topic:
-                self.safe_publish(packets_topic, json.dumps(message))
+                if packet_match.group(6) == "D" and path:
+                    payload["path"] = path
+
+            message = {
+                "origin": self.repeater_name,
+                "origin_id": self.repeater_pub_key,
+                "timestamp": iso_now(),
+                **payload
+            }
+            self._publish_packet(packets_topic, dumps_json(message))
             return
 
+        # Handle DEBUG messages
+        if self.debug:
+            if line.startswith("DEBUG"):
+                message = {
+                    "origin": self.repeater_name,
+                    "origin_id": self.repeater_pub_key,
+                    "timestamp": iso_now(),
+                    "type": "DEBUG",
+                    "message": line
+                }
+                debug_topic = self.get_topic("debug")
+                if debug_topic:
+                    self.safe_publish(debug_topic, dumps_json(message), batch=True)
+                return
+
     def handle_signal(self, signum, frame):
         """Signal handler to trigger graceful shutdown."""
         logger.info(f"Received signal {signum}, shutting down...")
@@ -1277,6 +1829,16 @@ class MeshCoreBridge:
     def wait_for_system_time_sync(self):
         attempts = 0
         while attempts < 60 and not self.should_exit:
+            attempts += 1
+            # Ask the kernel directly; timedatectl is only needed where adjtimex isn't available
+            synced = kernel_clock_synchronized()
+            if synced:
+                return True
+            if synced is False:
+                logger.warning("System clock is not synchronized")
+                time.sleep(1)
+                continue
+
             result = subprocess.run(
                 ['timedatectl', 'status'],
                 capture_output=True,
@@ -1299,6 +1861,7 @@ class MeshCoreBridge:
         
         if not self.connect_serial():
             return
+        self.start_serial_reader()
 
         if self.sync_time_at_start:
             if self.wait_for_system_time_sync():
@@ -1317,6 +1880,11 @@ class MeshCoreBridge:
         
         if not self.get_repeater_privkey():
             logger.warning("Failed to get repeater private key - auth token authentication will not be available")
+        else:
+            try:
+                self.signing_key = load_signing_key(self._repeater_pub_key_bytes, self._repeater_priv_key_bytes)
+            except (ValueError, ImportError) as e:
+                logger.warning(f"Repeater private key unusable for auth tokens: {e}")
         
         # Get radio info before connecting to MQTT
         self.radio_info = self.get_radio_info()
@@ -1337,8 +1905,9 @@ class MeshCoreBridge:
         # Get initial device stats
         device_stats = self.get_device_stats()
         if device_stats:
-            self.stats['device'] = device_stats
-            self.stats['device_prev'] = device_stats.copy()
+            self.stats.device = device_stats
+            self.stats.device_prev = device_stats.copy()
+            self._status_payload_cache = (None, b'')
             logger.info(f"Device stats: {device_stats}")
         else:
             logger.debug("Device stats not available (firmware may not support stats commands)")
@@ -1356,7 +1925,7 @@ class MeshCoreBridge:
                 retry_count += 1
                 wait_time = min(retry_count * 2, 30)  # Max 30 seconds between initial retries
                 logger.warning(f"[MQTT] Initial connection failed. Retrying in {wait_time}s... (attempt {retry_count}/{max_initial_retries})")
-                sleep(wait_time)
+                time.sleep(wait_time)
         
         if retry_count >= max_initial_retries:
             logger.error("[MQTT] Failed to establish initial connection after maximum retries")
@@ -1379,25 +1948,29 @@ class MeshCoreBridge:
                 # Check and reconnect any disconnected brokers
                 self.reconnect_disconnected_brokers()
                 
+                # Block until the serial reader queues a line; the timeout keeps the
+                # reconnect check and should_exit ticking while the radio is quiet
                 try:
-                    # Check for serial data (with lock for thread safety)
-                    with self.ser_lock:
-                        if self.ser and self.ser.in_waiting > 0:
-                            line = self.ser.readline().decode(errors='replace').strip()
-                            logger.debug(f"RX: {line}")
-                            self.parse_and_publish(line)
-                except OSError:
-                    logger.warning("Serial connection unavailable, trying to reconnect")
-                    self.close_serial()
-                    self.connect_serial()
-                    sleep(0.5)
-                sleep(0.01)
+                    line = self._rx_lines.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                while True:
+                    logger.debug("RX: %s", line)
+                    self.parse_and_publish(line)
+                    try:
+                        line = self._rx_lines.get_nowait()
+                    except queue.Empty:
+                        break
                 
         except KeyboardInterrupt:
             logger.info("\nExiting...")
         except Exception as e:
             logger.exception(f"Unhandled error in main loop: {e}")
         finally:
+            # Send any open batches before the clients go away
+            for batcher in self._batchers.values():
+                batcher.flush_all()
+            
             # Cleanup MQTT clients
             for mqtt_client_info in self.mqtt_clients:
                 try:
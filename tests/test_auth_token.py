@@ -0,0 +1,47 @@
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth_token
+
+try:
+    from nacl.signing import SigningKey
+except ImportError:
+    SigningKey = None
+
+
+def meshcore_keypair(seed):
+    """Public key and orlp-expanded private key (clamped scalar || prefix) for a seed"""
+    digest = bytearray(hashlib.sha512(seed).digest())
+    digest[0] &= 248
+    digest[31] &= 63
+    digest[31] |= 64
+    return bytes(SigningKey(seed).verify_key), bytes(digest)
+
+
+@unittest.skipIf(SigningKey is None, "PyNaCl not installed")
+class ExpandedKeySignerTest(unittest.TestCase):
+    def test_signature_matches_libsodium(self):
+        seed = bytes(range(32))
+        public_key, private_key = meshcore_keypair(seed)
+        scalar, prefix, loaded_public, _ = auth_token.load_signing_key(public_key, private_key)
+        for message in (b"", b"abc", b"x" * 1000):
+            self.assertEqual(
+                auth_token.ed25519_sign_expanded(message, scalar, prefix, loaded_public),
+                SigningKey(seed).sign(message).signature,
+            )
+
+    def test_token_verifies(self):
+        public_key, private_key = meshcore_keypair(b"\x07" * 32)
+        key = auth_token.load_signing_key(public_key.hex(), private_key.hex())
+        token = auth_token.create_auth_token(public_key.hex(), key, aud="mqtt.example.com")
+        claims = auth_token.verify_auth_token(token, public_key)
+        self.assertEqual(claims["publicKey"], public_key.hex().upper())
+        self.assertEqual(claims["aud"], "mqtt.example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()